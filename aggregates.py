@@ -0,0 +1,92 @@
+import logging
+from contextlib import contextmanager
+
+from store import Rollback
+
+logger = logging.getLogger(__name__)
+
+
+def empty_stats():
+    """Return the counters of an empty shop."""
+    return {"products": 0, "users": 0, "orders": 0, "order_status": {}, "pending_order_ids": []}
+
+
+def count(stats, entity, delta=1):
+    """Add delta to the number of products, users or orders."""
+    stats[entity] += delta
+
+
+def count_order(stats, order_id, status, total, delta=1):
+    """Add (delta=1) or take out (delta=-1) an order with this status and total."""
+    by_status = stats["order_status"].setdefault(status, {"count": 0, "revenue": 0.0})
+    by_status["count"] += delta
+    by_status["revenue"] = round(by_status["revenue"] + delta * float(total or 0), 2)
+    if status == "pending":
+        pending = stats["pending_order_ids"]
+        if delta > 0 and order_id not in pending:
+            pending.append(order_id)
+            # New orders arrive in id order; only re-opened ones need moving back into place
+            if len(pending) > 1 and (len(pending[-2]), pending[-2]) > (len(order_id), order_id):
+                pending.sort(key=lambda order_id: (len(order_id), order_id))
+        elif delta < 0 and order_id in pending:
+            pending.remove(order_id)
+
+
+class Aggregates:
+    """Dashboard counters kept in one small file and changed with every write.
+
+    The file holds the number of products, users and orders, the order count
+    and revenue for each status, and the ids of pending orders in id order,
+    so showing the dashboard costs one small read however much data there is.
+
+    Writers wrap the data write in ``change()``. Under the stats file's
+    exclusive lock the counters are saved marked as pending, the block writes
+    the data and updates the counters it was handed, and they are saved again
+    unmarked once ``durable()`` has made the data write durable (e.g. flushed
+    write-behind changes). Counters found still pending were left by a writer
+    that died between the two writes; like missing ones they are counted from
+    the data with ``seed()``.
+
+    The file needs a store without write-behind: every update is then a
+    locked read-modify-write of what is on disk, never a merge of copies.
+    """
+
+    def __init__(self, file_path, store, seed, durable=None):
+        if store.write_behind:
+            raise ValueError("Aggregates need a store without write-behind")
+        self.file_path = file_path
+        self.store = store
+        self.seed = seed
+        self.durable = durable
+
+    def get(self):
+        """Return the current counters."""
+        stats = self.store.load(self.file_path)
+        if not stats or stats.get("pending"):
+            # Missing, or a writer is halfway through (this waits for it) or died there
+            with self.store.transaction(self.file_path) as stats:
+                if not self._seed(stats):
+                    raise Rollback
+        return stats
+
+    @contextmanager
+    def change(self):
+        """Hold the counters across a write to the data, yielding them to be updated for it."""
+        with self.store.transaction(self.file_path) as stats:
+            self._seed(stats)
+            stats["pending"] = True
+            self.store.save(self.file_path, stats)
+            yield stats
+            if self.durable:
+                self.durable()
+            del stats["pending"]
+
+    def _seed(self, stats):
+        """Count the data into counters that are missing or were left pending; returns True if it did."""
+        if stats and not stats.get("pending"):
+            return False
+        stats.clear()
+        stats.update(self.seed())
+        logger.info(f"Counted {stats['products']} products, {stats['users']} users and "
+                    f"{stats['orders']} orders into {self.file_path}")
+        return True
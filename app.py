@@ -1,12 +1,18 @@
 import os
 import json
+import hashlib
 import logging
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, make_response, jsonify, Response
+from werkzeug.http import is_resource_modified
 from werkzeug.security import check_password_hash, generate_password_hash
-from datetime import datetime
+from datetime import datetime, timezone
 import data
-from config import ADMIN_USERNAME, ADMIN_PASSWORD, HOST, PORT
+from config import ADMIN_USERNAME, ADMIN_PASSWORD, HOST, PORT, BROADCASTS_DIR, RENDER_CACHE_SIZE, PAGE_CACHE_BYTES
+from outbox import queue_broadcast, list_broadcasts
 from forms import SignupForm, LoginForm
+from order_export import export_orders
+from product_import import format_for, import_products
+from render_cache import RenderCache
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -17,6 +23,12 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key")
 app.config['SECRET_KEY'] = os.environ.get("SESSION_SECRET", "dev_secret_key")
 
+# Order list and dashboard options
+ORDER_STATUSES = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+ORDER_SORTS = ['created_at', 'total', 'status']
+ORDERS_PER_PAGE = 50
+DASHBOARD_PENDING_ORDERS = 20
+
 # Check if admin exists, if not create default admin
 def init_admin():
     admin_path = "data/admin.json"
@@ -34,8 +46,7 @@ def init_data_files():
     # Ensure all data files exist
     data.get_all_products()
     data.get_all_users()
-    data.get_all_orders()
-    data.load_json(data.CARTS_FILE)
+    # Orders are kept in segments created as orders come in, so there is nothing to create for them
 
 # Check if user is logged in
 def is_logged_in():
@@ -51,23 +62,70 @@ def login_required(route_function):
     wrapper.__name__ = route_function.__name__
     return wrapper
 
+# Rendered admin pages, only the latest one per (path, user), with the data stamp it was rendered from
+page_cache = RenderCache(RENDER_CACHE_SIZE, max_bytes=PAGE_CACHE_BYTES, weigh=lambda cached: len(cached[1]))
+
+# Conditional GET decorator
+def cached_page(get_stamp):
+    """Serve a page with ETag and Last-Modified validators from get_stamp(**route_kwargs).
+    
+    An unchanged page is answered with 304, and one already rendered for the
+    same data is served from page_cache, skipping both the data reads and the
+    template. Pages with flash messages waiting are always rendered fresh.
+    """
+    def decorator(route_function):
+        def wrapper(*args, **kwargs):
+            stamp = get_stamp(**kwargs)
+            if stamp is None or session.get('_flashes'):
+                return route_function(*args, **kwargs)
+            
+            tag, modified = stamp
+            key = (request.full_path, session.get('username'))
+            etag = hashlib.blake2b(repr(key + (tag,)).encode(), digest_size=12).hexdigest()
+            last_modified = datetime.fromtimestamp(int(modified), timezone.utc) if modified else None
+            
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = make_response('', 304)
+            else:
+                # A page rendered from older data is replaced rather than kept beside the new one
+                cached = page_cache.get(key)
+                if cached is None or cached[0] != tag:
+                    response = make_response(route_function(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    page_cache.put(key, (tag, response.get_data()))
+                else:
+                    response = make_response(cached[1])
+            
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # Admin pages are per user and must be revalidated on every view
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        wrapper.__name__ = route_function.__name__
+        return wrapper
+    return decorator
+
 # Routes
 @app.route('/')
 def index():
     if is_logged_in():
-        product_count = len(data.get_all_products())
-        order_count = len(data.get_all_orders())
-        user_count = len(data.get_all_users())
+        # Counters kept up to date by the data layer, so nothing is counted here
+        stats = data.get_dashboard_stats()
         
-        # Get pending orders
-        orders = data.get_all_orders()
-        pending_orders = [order for order in orders.values() if order['status'] == 'pending']
+        # Newest pending orders first
+        pending_ids = stats['pending_order_ids'][-DASHBOARD_PENDING_ORDERS:][::-1]
+        pending_orders = [order for order in map(data.get_order, pending_ids) if order]
         
         return render_template('index.html', 
-                              product_count=product_count, 
-                              order_count=order_count, 
-                              user_count=user_count,
+                              product_count=stats['products'], 
+                              order_count=stats['orders'], 
+                              user_count=stats['users'],
+                              order_status=stats['order_status'],
+                              pending_count=len(stats['pending_order_ids']),
                               pending_orders=pending_orders,
+                              statuses=ORDER_STATUSES,
                               now=datetime.now())
     return redirect(url_for('login'))
 
@@ -134,6 +192,7 @@ def logout():
 
 @app.route('/products')
 @login_required
+@cached_page(lambda: data.get_stamp('products'))
 def products():
     products = data.get_all_products()
     return render_template('products.html', products=products, now=datetime.now())
@@ -173,6 +232,30 @@ def product_add():
     
     return render_template('product_add.html', now=datetime.now())
 
+@app.route('/products/import', methods=['GET', 'POST'])
+@login_required
+def product_import():
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if upload is None:
+            # API use: the file is the request body, e.g. Content-Type: text/csv
+            fmt = request.args.get('format') or format_for(content_type=request.content_type)
+            if fmt not in ('csv', 'ndjson'):
+                return jsonify({'error': 'Send CSV or NDJSON, or pass ?format=csv|ndjson'}), 415
+            return jsonify(import_products(request.stream, fmt))
+        
+        fmt = request.form.get('format') or format_for(upload.filename, upload.content_type)
+        if fmt not in ('csv', 'ndjson'):
+            flash('Upload a .csv or .ndjson file, or choose its format', 'danger')
+            return render_template('product_import.html', now=datetime.now())
+        
+        report = import_products(upload.stream, fmt)
+        flash(f"Imported {report['rows']} rows: {report['created']} created, {report['updated']} updated, "
+              f"{report['rejected']} rejected", 'success' if not report['rejected'] else 'warning')
+        return render_template('product_import.html', report=report, now=datetime.now())
+    
+    return render_template('product_import.html', now=datetime.now())
+
 @app.route('/products/edit/<product_id>', methods=['GET', 'POST'])
 @login_required
 def product_edit(product_id):
@@ -233,14 +316,70 @@ def product_delete(product_id):
     
     return redirect(url_for('products'))
 
+def date_arg(name):
+    """Return a YYYY-MM-DD query argument, or None if it is missing or malformed."""
+    value = request.args.get(name, '')
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return None
+    return value
+
 @app.route('/orders')
 @login_required
+@cached_page(lambda: data.get_stamp('orders'))
 def orders():
-    all_orders = data.get_all_orders()
-    return render_template('orders.html', orders=all_orders)
+    # Only the requested page is read; sorting and filtering use the order index
+    filters = {
+        'status': request.args.get('status') if request.args.get('status') in ORDER_STATUSES else None,
+        'date_from': date_arg('from'),
+        'date_to': date_arg('to'),
+        'sort': request.args.get('sort') if request.args.get('sort') in ORDER_SORTS else 'created_at',
+        'descending': request.args.get('dir') != 'asc'
+    }
+    per_page = min(max(request.args.get('per_page', ORDERS_PER_PAGE, type=int), 1), 200)
+    page = max(request.args.get('page', 1, type=int), 1)
+    
+    page_orders, count = data.get_orders_page(page=page, per_page=per_page, **filters)
+    pages = max((count + per_page - 1) // per_page, 1)
+    if page > pages:
+        page = pages
+        page_orders, count = data.get_orders_page(page=page, per_page=per_page, **filters)
+    
+    # Query string for links to other pages of the same list
+    query = {
+        'status': filters['status'],
+        'from': filters['date_from'],
+        'to': filters['date_to'],
+        'sort': filters['sort'],
+        'dir': 'desc' if filters['descending'] else 'asc',
+        'per_page': per_page
+    }
+    query = {key: value for key, value in query.items() if value}
+    return render_template('orders.html', orders=page_orders, count=count, page=page, pages=pages,
+                          query=query, statuses=ORDER_STATUSES, now=datetime.now())
+
+@app.route('/orders/export')
+@login_required
+def orders_export():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    status = request.args.get('status') or None
+    if status is not None and status not in ORDER_STATUSES:
+        return jsonify({'error': f'status must be one of {", ".join(ORDER_STATUSES)}'}), 400
+    compress = request.args.get('gzip') in ('1', 'true', 'yes')
+    
+    # Orders are read and sent a chunk at a time, never held in memory all at once
+    chunks = export_orders(fmt, status, date_arg('from'), date_arg('to'), compress)
+    filename = f"orders.{fmt}" + ('.gz' if compress else '')
+    mimetype = 'application/gzip' if compress else ('text/csv' if fmt == 'csv' else 'application/x-ndjson')
+    return Response(chunks, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 @app.route('/orders/<order_id>')
 @login_required
+@cached_page(lambda order_id: data.get_stamp('order', order_id))
 def order_detail(order_id):
     order = data.get_order(order_id)
     
@@ -248,7 +387,7 @@ def order_detail(order_id):
         flash('Order not found', 'danger')
         return redirect(url_for('orders'))
     
-    return render_template('order_detail.html', order=order)
+    return render_template('order_detail.html', order=order, now=datetime.now())
 
 @app.route('/orders/update-status/<order_id>', methods=['POST'])
 @login_required
@@ -260,8 +399,7 @@ def update_order_status(order_id):
         flash('Order not found', 'danger')
         return redirect(url_for('orders'))
     
-    valid_statuses = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
-    if status not in valid_statuses:
+    if status not in ORDER_STATUSES:
         flash('Invalid status', 'danger')
         return redirect(url_for('order_detail', order_id=order_id))
     
@@ -273,6 +411,21 @@ def update_order_status(order_id):
     
     return redirect(url_for('order_detail', order_id=order_id))
 
+@app.route('/broadcast', methods=['GET', 'POST'])
+@login_required
+def broadcast():
+    if request.method == 'POST':
+        message = request.form.get('message', '').strip()
+        if not message:
+            flash('Message is required', 'danger')
+        else:
+            # The bot process picks the job up and sends it through its rate-limited outbox
+            queue_broadcast(BROADCASTS_DIR, message)
+            flash('Broadcast queued, the bot will start sending it shortly', 'success')
+            return redirect(url_for('broadcast'))
+    
+    return render_template('broadcast.html', broadcasts=list_broadcasts(BROADCASTS_DIR), now=datetime.now())
+
 # Initialize admin and data files when app starts
 init_admin()
 init_data_files()
@@ -0,0 +1,46 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import data
+from config import DATA_THREADS
+
+logger = logging.getLogger(__name__)
+
+# Storage calls run here so file and database I/O never blocks the bot's event loop.
+# The pool is bounded: when it is busy, further calls queue instead of piling up threads.
+_executor = ThreadPoolExecutor(max_workers=DATA_THREADS, thread_name_prefix="data")
+
+
+async def run(func, *args, **kwargs):
+    """Run a blocking function on the data thread pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def _offload(name):
+    func = getattr(data, name)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+# Awaitable versions of the data.py functions the bot uses
+get_all_products = _offload("get_all_products")
+get_product = _offload("get_product")
+get_catalog_version = _offload("get_catalog_version")
+search_products = _offload("search_products")
+get_user = _offload("get_user")
+add_or_update_user = _offload("add_or_update_user")
+get_cart = _offload("get_cart")
+add_to_cart = _offload("add_to_cart")
+update_cart_item = _offload("update_cart_item")
+clear_cart = _offload("clear_cart")
+create_order = _offload("create_order")
+get_order = _offload("get_order")
+get_user_orders = _offload("get_user_orders")
+get_all_users = _offload("get_all_users")
+update_order_status = _offload("update_order_status")
@@ -0,0 +1,531 @@
+"""Micro-benchmarks for the storage and bot layers.
+
+Run ``python bench.py <name> [options]``; ``python bench.py -h`` lists them.
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+
+def best_of(repeat, func):
+    """Return the fastest of repeat timed calls of func, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# Generated datasets
+
+def make_products(count):
+    return {
+        str(i): {
+            "id": str(i),
+            "name": f"Product {i}",
+            "description": f"Generated product number {i} for benchmarking.",
+            "price": round(random.uniform(1, 500), 2),
+            "stock": random.randint(0, 1000),
+            "image_url": "",
+            "created_at": datetime(2024, 1, 1).isoformat()
+        }
+        for i in range(1, count + 1)
+    }
+
+
+def make_orders(count, products=50):
+    start = datetime(2024, 1, 1)
+    orders = {}
+    for i in range(1, count + 1):
+        items = {
+            str(product_id): {
+                "product_name": f"Product {product_id}",
+                "price": round(random.uniform(1, 500), 2),
+                "quantity": random.randint(1, 5)
+            }
+            for product_id in random.sample(range(1, products + 1), random.randint(1, 4))
+        }
+        orders[str(i)] = {
+            "id": str(i),
+            "user_id": str(random.randint(10**8, 10**9)),
+            "user_data": {"username": f"user{i}", "first_name": "Test", "last_name": None},
+            "items": items,
+            "total": sum(item["price"] * item["quantity"] for item in items.values()),
+            "address": f"Jl. Benchmark No. {i}, Jakarta",
+            "status": random.choice(["pending", "processing", "shipped", "delivered", "cancelled"]),
+            "created_at": (start + timedelta(minutes=i)).isoformat()
+        }
+    return orders
+
+
+# Benchmarks
+
+def bench_codec(args):
+    """Compare encode/decode and file save/load throughput of every available codec."""
+    import codec
+    from store import write_atomic
+
+    codecs = [
+        codec.JsonCodec(pretty=True, fast=False),
+        codec.JsonCodec(fast=False),
+    ]
+    if codec.orjson is not None:
+        codecs += [codec.JsonCodec(pretty=True), codec.JsonCodec()]
+    if codec.msgpack is not None:
+        codecs.append(codec.MsgpackCodec())
+
+    datasets = [
+        (f"{args.records} products", make_products(args.records)),
+        (f"{args.records} orders", make_orders(args.records)),
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for label, dataset in datasets:
+            print(f"\n{label}")
+            print(f"{'codec':<14}{'size KiB':>10}{'dumps MB/s':>12}{'loads MB/s':>12}"
+                  f"{'save/s':>10}{'load/s':>10}")
+            for c in codecs:
+                raw = c.dumps(dataset)
+                mb = len(raw) / 1e6
+                dumps = best_of(args.repeat, lambda: c.dumps(dataset))
+                loads = best_of(args.repeat, lambda: c.loads(raw))
+
+                path = os.path.join(directory, "data")
+
+                def load():
+                    with open(path, 'rb') as f:
+                        c.loads(f.read())
+
+                save = best_of(args.repeat, lambda: write_atomic(path, dataset, c))
+                load_time = best_of(args.repeat, load)
+                print(f"{c.name:<14}{len(raw) / 1024:>10.0f}{mb / dumps:>12.1f}{mb / loads:>12.1f}"
+                      f"{1 / save:>10.1f}{1 / load_time:>10.1f}")
+
+
+@contextmanager
+def scratch_data_dir():
+    """Run with a fresh, empty data directory and import the data layer inside it."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            import data
+            logging.disable(logging.INFO)
+            yield data
+        finally:
+            os.chdir(cwd)
+
+
+def bench_async_data(args):
+    """Cart updates per second from concurrent users, with storage inline vs on the thread pool."""
+    import asyncio
+
+    with scratch_data_dir() as data:
+        import async_data
+
+        product_id = data.add_product({
+            "name": "Benchmark product", "description": "", "price": 10.0, "stock": 10**6
+        })
+
+        async def tap(user_id, offload):
+            # Roughly what /start followed by a cart tap costs
+            if offload:
+                await async_data.add_or_update_user(user_id, {"username": f"user{user_id}"})
+                await async_data.add_to_cart(user_id, product_id, 1)
+                await async_data.get_cart(user_id)
+            else:
+                data.add_or_update_user(user_id, {"username": f"user{user_id}"})
+                data.add_to_cart(user_id, product_id, 1)
+                data.get_cart(user_id)
+
+        async def run(offload):
+            max_lag = 0.0
+            done = asyncio.Event()
+
+            async def ticker():
+                # How late the loop gets around to a 1 ms timer shows how long it was blocked
+                nonlocal max_lag
+                while not done.is_set():
+                    start = time.perf_counter()
+                    await asyncio.sleep(0.001)
+                    max_lag = max(max_lag, time.perf_counter() - start - 0.001)
+
+            async def user(user_id):
+                for _ in range(args.taps):
+                    await tap(user_id, offload)
+
+            watcher = asyncio.create_task(ticker())
+            start = time.perf_counter()
+            await asyncio.gather(*(user(user_id) for user_id in range(args.users)))
+            elapsed = time.perf_counter() - start
+            done.set()
+            await watcher
+            return args.users * args.taps / elapsed, max_lag
+
+        print(f"{args.users} concurrent users x {args.taps} updates, {async_data.DATA_THREADS} data threads")
+        print(f"{'mode':<12}{'updates/s':>12}{'max loop stall ms':>20}")
+        for label, offload in (("inline", False), ("offloaded", True)):
+            throughput, lag = asyncio.run(run(offload))
+            print(f"{label:<12}{throughput:>12.0f}{lag * 1000:>20.1f}")
+
+
+def make_words(count):
+    """Return count distinct pseudo-words, for realistic product names and descriptions."""
+    syllables = ["ka", "ri", "mo", "te", "lu", "pa", "si", "no", "be", "da", "gu", "ro", "wi", "ze", "han", "tor"]
+    words = set()
+    while len(words) < count:
+        words.add("".join(random.choice(syllables) for _ in range(random.randint(2, 4))))
+    return sorted(words)
+
+
+def bench_search(args):
+    """Index build, incremental update and query latency of the product search index."""
+    import statistics
+    from search import SearchIndex
+
+    vocabulary = make_words(5000)
+    products = {
+        str(i): {
+            "id": str(i),
+            "name": " ".join(random.sample(vocabulary, 3)),
+            "description": " ".join(random.choices(vocabulary, k=12)),
+            "price": 10.0,
+            "stock": 1,
+            "version": 1
+        }
+        for i in range(1, args.records + 1)
+    }
+
+    index = SearchIndex()
+    start = time.perf_counter()
+    index.sync(products, 1)
+    build = time.perf_counter() - start
+
+    edited = random.sample(sorted(products), 10)
+    for product_id in edited:
+        products[product_id] = dict(products[product_id], name=" ".join(random.sample(vocabulary, 3)), version=2)
+    start = time.perf_counter()
+    index.sync(products, 2)
+    resync = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index.add(edited[0], dict(products[edited[0]], name="renamed product", version=3))
+    add = time.perf_counter() - start
+
+    print(f"{args.records} products, {len(vocabulary)} word vocabulary")
+    print(f"full build {build * 1000:.0f} ms, sync after 10 edits {resync * 1000:.1f} ms, "
+          f"single add {add * 1e6:.0f} us")
+
+    sample = random.sample(sorted(products), 200)
+    queries = {
+        "1-letter prefix": [products[p]["name"][:1] for p in sample],
+        "3-letter prefix": [products[p]["name"][:3] for p in sample],
+        "one word": [products[p]["name"].split()[0] for p in sample],
+        "two words": [" ".join(products[p]["name"].split()[:2]) for p in sample],
+        "word + prefix": [products[p]["name"].split()[0] + " " + products[p]["description"][:2] for p in sample],
+        "no match": ["zzz" + products[p]["name"][:3] for p in sample],
+    }
+    print(f"{'query':<18}{'median us':>12}{'p99 us':>10}{'hits':>8}")
+    for label, texts in queries.items():
+        timings = []
+        hits = 0
+        for text in texts:
+            start = time.perf_counter()
+            hits += len(index.search(text, 20))
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"{label:<18}{statistics.median(timings) * 1e6:>12.1f}"
+              f"{timings[int(len(timings) * 0.99)] * 1e6:>10.1f}{hits / len(texts):>8.1f}")
+
+
+def bench_outbox(args):
+    """Broadcast through the outbox to a fake Bot API and check the achieved send rate."""
+    import asyncio
+    from telegram.error import RetryAfter
+    from outbox import Outbox
+
+    class FakeBot:
+        def __init__(self):
+            self.calls = 0
+            self.last_by_chat = {}
+            self.min_chat_gap = float('inf')
+
+        async def send_message(self, chat_id, text, **kwargs):
+            self.calls += 1
+            await asyncio.sleep(0.02)  # API round trip
+            if random.random() < 0.001:
+                raise RetryAfter(1)
+            now = time.perf_counter()
+            if chat_id in self.last_by_chat:
+                self.min_chat_gap = min(self.min_chat_gap, now - self.last_by_chat[chat_id])
+            self.last_by_chat[chat_id] = now
+            return True
+
+    logging.disable(logging.WARNING)
+
+    async def run():
+        bot = FakeBot()
+        outbox = Outbox(bot, rate=args.rate)
+        outbox.start()
+        chat_ids = list(range(args.records))
+        start = time.perf_counter()
+        # A notification stream to one chat alongside the broadcast, to exercise the per-chat limit
+        notifications = [await outbox.send(-1 if i % 2 else 7, "order update") for i in range(5)]
+        sent, failed = await outbox.broadcast(chat_ids, "announcement")
+        await asyncio.gather(*notifications)
+        elapsed = time.perf_counter() - start
+        await outbox.stop()
+        print(f"{args.records} chats at {args.rate:.0f} msg/s allowed: {sent} sent, {failed} failed, "
+              f"{outbox.retried} retried after RetryAfter")
+        print(f"achieved {(sent + len(notifications)) / elapsed:.0f} msg/s in {elapsed:.1f}s, "
+              f"{bot.calls} API calls, smallest gap between two messages to one chat "
+              f"{bot.min_chat_gap:.2f}s")
+
+    asyncio.run(run())
+
+
+def bench_orders(args):
+    """Admin order list: the whole history versus one page from the sorted index."""
+    import json
+
+    with scratch_data_dir() as data:
+        from config import ORDERS_FILE
+        with open(ORDERS_FILE, 'w') as f:
+            json.dump(make_orders(args.records), f)
+        data.get_order("1")  # split into segments
+
+        # A day in the middle of the generated history, whatever its length
+        day = data.get_order(str(args.records // 2 + 1))["created_at"][:10]
+        cases = [
+            ("all, newest first", {}),
+            ("page 20 by total", {"page": 20, "sort": "total"}),
+            ("pending only", {"status": "pending"}),
+            ("one day, shipped", {"date_from": day, "date_to": day, "status": "shipped"}),
+        ]
+        print(f"{args.records} orders, 50 per page")
+        print(f"{'query':<22}{'full sort ms':>14}{'page ms':>10}{'matches':>10}")
+        for label, filters in cases:
+            def full():
+                orders = [
+                    order for order in data.get_all_orders().values()
+                    if order["status"] == filters.get("status", order["status"])
+                    and filters.get("date_from", "") <= order["created_at"][:10] <= filters.get("date_to", "~")
+                ]
+                orders.sort(key=lambda order: order[filters.get("sort", "created_at")], reverse=True)
+            full_time = best_of(args.repeat, full)
+            page_time = best_of(args.repeat, lambda: data.get_orders_page(**filters))
+            print(f"{label:<22}{full_time * 1000:>14.1f}{page_time * 1000:>10.2f}"
+                  f"{data.get_orders_page(**filters)[1]:>10}")
+
+
+def bench_reservations(args):
+    """Many shoppers grabbing units of one hot product at once; checks throughput and overselling."""
+    import threading
+    from reservations import StockReservations
+
+    stock = args.records // 4
+    attempts_per_thread = args.records // args.users
+
+    def run(get_stock):
+        holds = StockReservations(get_stock)
+        granted = [0] * args.users
+        start_line = threading.Barrier(args.users + 1)
+
+        def shopper(n):
+            start_line.wait()
+            for i in range(attempts_per_thread):
+                if holds.reserve(f"user{n}-{i}", "1", 1):
+                    granted[n] += 1
+
+        threads = [threading.Thread(target=shopper, args=(n,)) for n in range(args.users)]
+        for thread in threads:
+            thread.start()
+        start_line.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return sum(granted), args.users * attempts_per_thread / elapsed
+
+    print(f"{args.users} threads x {attempts_per_thread} reservations of 1 unit, {stock} units in stock")
+    print(f"{'stock source':<16}{'reservations/s':>16}{'granted':>10}{'oversold':>10}")
+    with scratch_data_dir() as data:
+        product_id = data.add_product({"name": "Hot product", "description": "", "price": 1.0, "stock": stock})
+        sources = [("in memory", lambda product_id: stock), ("data.get_stock", data.get_stock)]
+        for label, get_stock in sources:
+            granted, rate = run(lambda _, get_stock=get_stock: get_stock(product_id))
+            print(f"{label:<16}{rate:>16.0f}{granted:>10}{max(0, granted - stock):>10}")
+
+
+def bench_webhook(args):
+    """Post updates to the webhook listener and check the bot's replies at a stub Bot API server."""
+    import asyncio
+    import json
+    import socket
+    import threading
+    import urllib.error
+    import urllib.request
+    from collections import Counter
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qsl
+
+    calls = []
+    calls_lock = threading.Lock()
+
+    class BotApi(BaseHTTPRequestHandler):
+        """Answers every Bot API method like Telegram would, recording (method, parameters)."""
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            method = self.path.rsplit("/", 1)[-1]
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+            params = dict(parse_qsl(body))
+            with calls_lock:
+                calls.append((method, params))
+                message_id = len(calls)
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            elif method in ("sendMessage", "editMessageText"):
+                result = {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": int(params["chat_id"]), "type": "private"},
+                    "text": params.get("text", "")
+                }
+            else:
+                result = True
+            raw = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def log_message(self, format, *args):
+            pass
+
+    api = ThreadingHTTPServer(("127.0.0.1", 0), BotApi)
+    api.daemon_threads = True
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{api.server_address[1]}"
+    os.environ["TELEGRAM_BOT_TOKEN"] = "123456:bench"
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    url = f"http://127.0.0.1:{port}/webhook"
+    secret = "bench-secret"
+
+    def post(body, token=secret, path="/webhook"):
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{port}{path}", data=body, method="POST",
+            headers={"X-Telegram-Bot-Api-Secret-Token": token, "Content-Type": "application/json"}
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def start_update(update_id, user_id):
+        return json.dumps({"update_id": update_id, "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+        }}).encode()
+
+    async def run(bot):
+        stop = asyncio.Event()
+        from webhook import serve_webhook
+        server = asyncio.create_task(serve_webhook(
+            bot.create_bot_application(), url, "127.0.0.1", port, secret, stop
+        ))
+        while not any(method == "setWebhook" for method, _ in calls):
+            await asyncio.sleep(0.01)
+
+        # Requests that must be refused without reaching the handlers
+        refused = [
+            (b"[]", secret, "/webhook", 400),
+            (b"{}", secret, "/webhook", 400),
+            (b"null", secret, "/webhook", 400),
+            (b"not json", secret, "/webhook", 400),
+            (start_update(1, 1), "wrong", "/webhook", 403),
+            (start_update(1, 1), secret, "/other", 404),
+        ]
+        for body, token, path, expected in refused:
+            status = await asyncio.to_thread(post, body, token, path)
+            assert status == expected, f"{body[:20]!r} to {path} answered {status}, expected {expected}"
+
+        user_ids = [10**8 + n for n in range(args.users)]
+        updates = [
+            start_update(tap * args.users + n + 2, user_id)
+            for tap in range(args.taps) for n, user_id in enumerate(user_ids)
+        ]
+        start = time.perf_counter()
+        statuses = await asyncio.gather(*(asyncio.to_thread(post, body) for body in updates))
+        accepted = time.perf_counter() - start
+        assert statuses == [200] * len(updates), f"webhook answered {Counter(statuses)}"
+
+        def replies():
+            with calls_lock:
+                return [params for method, params in calls if method == "sendMessage"]
+        deadline = time.perf_counter() + 30
+        while len(replies()) < len(updates) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        answered = time.perf_counter() - start
+        stop.set()
+        await server
+
+        sent = replies()
+        per_chat = Counter(int(params["chat_id"]) for params in sent)
+        assert len(sent) == len(updates), f"{len(sent)} replies to {len(updates)} updates"
+        assert per_chat == {user_id: args.taps for user_id in user_ids}, "replies went to the wrong chats"
+        assert all(params["text"].startswith("Welcome") for params in sent), "unexpected reply text"
+        print(f"{len(refused)} bad requests refused, {len(updates)} updates from {args.users} users accepted "
+              f"in {accepted:.2f}s ({len(updates) / accepted:.0f}/s), all answered after {answered:.2f}s")
+
+    try:
+        with scratch_data_dir():
+            import bot
+            # The refused requests are logged as errors on purpose
+            logging.disable(logging.ERROR)
+            asyncio.run(run(bot))
+    finally:
+        api.shutdown()
+
+
+BENCHMARKS = {
+    "async-data": bench_async_data,
+    "codec": bench_codec,
+    "orders": bench_orders,
+    "outbox": bench_outbox,
+    "reservations": bench_reservations,
+    "search": bench_search,
+    "webhook": bench_webhook,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--records", type=int, default=20000, help="size of generated datasets")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, best is kept")
+    parser.add_argument("--users", type=int, default=50, help="concurrent simulated users")
+    parser.add_argument("--rate", type=float, default=1000, help="messages per second allowed by the outbox")
+    parser.add_argument("--taps", type=int, default=20, help="updates sent by each simulated user")
+    args = parser.parse_args()
+    random.seed(0)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
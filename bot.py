@@ -1,15 +1,35 @@
+import asyncio
+import atexit
 import logging
 import html
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from itertools import islice
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, InlineQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 from telegram.ext.filters import UpdateType
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-import data
+from telegram.error import BadRequest
+from telegram import (
+    InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent, Update
+)
+import async_data
 from utils import (
     paginate, create_pagination_keyboard, format_cart_message, create_cart_keyboard,
     format_product_message, create_product_keyboard, format_order_message,
     send_order_notification, send_status_update
 )
-from config import TOKEN
+from update_processor import PerUserUpdateProcessor
+from codec import get_codec
+from conversations import ConversationStore, ConversationPersistence
+from outbox import Outbox, watch_broadcasts
+from data import get_stock, decrement_stock, restock
+from quantity import QuantityPicker
+from reservations import StockReservations
+from render_cache import MessageFingerprints, RenderCache
+from config import (
+    TOKEN, TELEGRAM_API_URL, BOT_CONCURRENT_UPDATES, RENDER_CACHE_SIZE, QUANTITY_EDIT_DELAY_MS,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET,
+    OUTBOX_RATE, OUTBOX_CHAT_RATE, OUTBOX_GROUP_PER_MINUTE, OUTBOX_MAX_PENDING,
+    BROADCASTS_DIR, BROADCAST_POLL_SECONDS, CONVERSATIONS_FILE, CONVERSATION_TTL_SECONDS,
+    CONVERSATION_MAX_ENTRIES, CONVERSATION_FLUSH_SECONDS, DATA_CODEC, PRODUCTION, STOCK_HOLD_SECONDS
+)
 
 # Enable logging
 logging.basicConfig(
@@ -20,8 +40,63 @@ logger = logging.getLogger(__name__)
 # Conversation states
 ADDRESS, CONFIRM_ORDER = range(2)
 
-# Stores temporary user data during conversations
-user_data_store = {}
+# Checkout progress, bounded and saved across restarts
+conversations = ConversationStore(
+    CONVERSATIONS_FILE,
+    ttl=CONVERSATION_TTL_SECONDS,
+    max_entries=CONVERSATION_MAX_ENTRIES,
+    flush_interval=CONVERSATION_FLUSH_SECONDS,
+    codec=get_codec(DATA_CODEC, pretty=not PRODUCTION)
+)
+atexit.register(conversations.flush)
+
+# Rendered product list pages keyed by (page, catalog version),
+# and product cards keyed by (product id, product version)
+catalog_pages = RenderCache(RENDER_CACHE_SIZE)
+product_cards = RenderCache(RENDER_CACHE_SIZE)
+
+# What was last rendered into each message, so identical edits are skipped
+rendered_messages = MessageFingerprints(RENDER_CACHE_SIZE)
+
+# Stock held for what is in each user's cart, until checkout or expiry
+stock_holds = StockReservations(get_stock, hold_seconds=STOCK_HOLD_SECONDS)
+
+# Quantities picked with ➕/➖ on product cards, per (user, message)
+quantity_picker = QuantityPicker(QUANTITY_EDIT_DELAY_MS / 1000)
+
+def message_key(query):
+    """Identify the message a callback came from."""
+    if query.inline_message_id:
+        return query.inline_message_id
+    return (query.message.chat_id, query.message.message_id)
+
+async def edit_message(query, text, reply_markup=None, parse_mode=None):
+    """Edit the message a callback came from, unless it already shows exactly this."""
+    key = message_key(query)
+    # A new card or screen: quantities picked on the old one, and their pending edits, no longer apply
+    quantity_picker.forget(key)
+    markup = reply_markup.to_json() if reply_markup else None
+    if rendered_messages.is_shown(key, (text, parse_mode), markup):
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+    rendered_messages.record(key, (text, parse_mode), markup)
+
+async def edit_reply_markup(query, reply_markup):
+    """Replace the keyboard of the message a callback came from, unless it already has this one."""
+    key = message_key(query)
+    markup = reply_markup.to_json() if reply_markup else None
+    if rendered_messages.is_shown(key, markup=markup):
+        return
+    try:
+        await query.edit_message_reply_markup(reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+    rendered_messages.record(key, markup=markup)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
@@ -33,7 +108,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "first_name": user.first_name,
         "last_name": user.last_name
     }
-    data.add_or_update_user(user.id, user_info)
+    await async_data.add_or_update_user(user.id, user_info)
     
     keyboard = [
         [InlineKeyboardButton("🛍️ Browse Products", callback_data="browse_products_1")],
@@ -55,40 +130,23 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/start - Start the bot and see main menu\n"
         "/help - Show this help message\n"
         "/browse - Browse available products\n"
+        "/search - Search products by name\n"
         "/cart - View your shopping cart\n"
         "/orders - View your orders"
     )
     await update.message.reply_markdown(help_text)
 
-async def browse_products(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show list of products with pagination."""
-    query = update.callback_query
-    
-    if query:
-        # Extract page number from callback data
-        page = int(query.data.split("_")[-1])
-        await query.answer()
-    else:
-        # If called directly from command
-        page = 1
-    
-    products = data.get_all_products()
-    products_list = list(products.values())
-    
-    if not products_list:
-        message = "No products available at the moment."
-        if query:
-            await query.edit_message_text(message)
-        else:
-            await update.message.reply_text(message)
-        return
+def render_catalog_page(products, page, page_size=5):
+    """Render one page of the product list as (message, markup); markup is None if there are no products."""
+    if not products:
+        return "No products available at the moment.", None
     
-    # Paginate products
-    pages = list(paginate(products_list))
-    if page > len(pages):
+    total_pages = (len(products) + page_size - 1) // page_size
+    if page > total_pages:
         page = 1
     
-    current_page = pages[page-1]
+    start = (page - 1) * page_size
+    current_page = list(islice(products.values(), start, start + page_size))
     
     # Create message
     message = "*Available Products:*\n\n"
@@ -107,108 +165,177 @@ async def browse_products(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )])
     
     # Add pagination buttons
-    pagination = create_pagination_keyboard(page, len(pages), "browse_products")
+    pagination = create_pagination_keyboard(page, total_pages, "browse_products")
     keyboard.extend(pagination)
     
     # Add back to main menu button
     keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
     
-    markup = InlineKeyboardMarkup(keyboard)
+    return message, InlineKeyboardMarkup(keyboard)
+
+def render_product_card(product):
+    """Render a product's detail message as (message, markup)."""
+    return format_product_message(product), create_product_keyboard(product['id'])
+
+async def browse_products(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show list of products with pagination."""
+    query = update.callback_query
+    
+    if query:
+        # Extract page number from callback data
+        page = int(query.data.split("_")[-1])
+        await query.answer()
+    else:
+        # If called directly from command
+        page = 1
+    
+    # Pages are rendered once per catalog version; any product change moves to a new version
+    key = (page, await async_data.get_catalog_version())
+    rendered = catalog_pages.get(key)
+    if rendered is None:
+        products = await async_data.get_all_products()
+        rendered = catalog_pages.put(key, render_catalog_page(products, page))
+    message, markup = rendered
+    
+    if markup is None:
+        if query:
+            await edit_message(query, message)
+        else:
+            await update.message.reply_text(message)
+        return
     
     if query:
-        await query.edit_message_text(message, reply_markup=markup, parse_mode='Markdown')
+        await edit_message(query, message, reply_markup=markup, parse_mode='Markdown')
     else:
         await update.message.reply_markdown(message, reply_markup=markup)
 
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Search products by name or description with /search <words>."""
+    query_text = " ".join(context.args)
+    if not query_text:
+        await update.message.reply_text("Usage: /search <product name or keywords>")
+        return
+    
+    products = await async_data.search_products(query_text, limit=10)
+    if not products:
+        await update.message.reply_text(f"No products found for \"{query_text}\".")
+        return
+    
+    keyboard = []
+    for product in products:
+        keyboard.append([InlineKeyboardButton(
+            f"{product['name']} - ${float(product['price']):.2f}",
+            callback_data=f"view_product_{product['id']}"
+        )])
+    keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")])
+    
+    await update.message.reply_text(
+        f"Products matching \"{query_text}\":",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Answer inline queries (@bot <words>) with matching products."""
+    query = update.inline_query
+    products = await async_data.search_products(query.query, limit=20) if query.query.strip() else []
+    
+    results = [
+        InlineQueryResultArticle(
+            id=product['id'],
+            title=product['name'],
+            description=f"${float(product['price']):.2f} - Stock: {product['stock']}",
+            input_message_content=InputTextMessageContent(
+                format_product_message(product), parse_mode='Markdown'
+            )
+        )
+        for product in products
+    ]
+    await query.answer(results, cache_time=10)
+
 async def view_product(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show product details."""
     query = update.callback_query
     await query.answer()
     
     product_id = query.data.split("_")[-1]
-    product = data.get_product(product_id)
+    product = await async_data.get_product(product_id)
     
     if not product:
-        await query.edit_message_text("Product not found.")
+        await edit_message(query, "Product not found.")
         return
     
-    message = format_product_message(product)
-    markup = create_product_keyboard(product_id)
+    message, markup = product_cards.get_or_render(
+        (product_id, product.get('version')), lambda: render_product_card(product)
+    )
     
-    await query.edit_message_text(message, reply_markup=markup, parse_mode='Markdown')
+    await edit_message(query, message, reply_markup=markup, parse_mode='Markdown')
+
+def product_card_key(query):
+    """Identify the product card a callback came from, per user."""
+    return (message_key(query), query.from_user.id)
 
 async def adjust_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Adjust quantity before adding to cart."""
     query = update.callback_query
-    await query.answer()
-    
-    action, product_id = query.data.split("_")[1:]
-    product = data.get_product(product_id)
-    
-    if not product:
-        await query.edit_message_text("Product not found.")
-        return
-    
-    # Find the current quantity button
-    current_markup = query.message.reply_markup.inline_keyboard
-    qty_row = current_markup[0]
-    qty_button = qty_row[1]
-    current_qty = int(qty_button.text)
     
-    # Adjust quantity
-    if action == "increase":
-        current_qty += 1
-    elif action == "decrease" and current_qty > 1:
-        current_qty -= 1
-    
-    # Update the add to cart button
-    add_to_cart_row = current_markup[1]
-    add_to_cart_button = add_to_cart_row[0]
-    add_to_cart_button.callback_data = f"add_to_cart_{product_id}_{current_qty}"
-    
-    # Update the quantity button
-    qty_button.text = str(current_qty)
-    
-    # Recreate the markup
-    markup = InlineKeyboardMarkup(current_markup)
+    # qty_<increase|decrease>_<product id>_<quantity shown on the keyboard>
+    action, _, rest = query.data[len("qty_"):].partition("_")
+    product_id, _, shown_qty = rest.partition("_")
+    key = product_card_key(query)
+    quantity = quantity_picker.adjust(
+        key, product_id, 1 if action == "increase" else -1, shown=int(shown_qty or 1)
+    )
     
-    await query.edit_message_reply_markup(reply_markup=markup)
+    # Answer right away; the keyboard catches up once the user stops tapping
+    await query.answer(f"Quantity: {quantity}")
+    quantity_picker.schedule(
+        key,
+        lambda qty: edit_reply_markup(query, create_product_keyboard(product_id, qty))
+    )
 
 async def add_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Add a product to cart."""
     query = update.callback_query
-    await query.answer()
     
-    _, product_id, qty = query.data.split("_")
-    qty = int(qty)
+    # add_to_cart_<product id>_<quantity shown on the keyboard>
+    product_id, _, shown_qty = query.data[len("add_to_cart_"):].partition("_")
+    key = product_card_key(query)
+    qty = quantity_picker.get(key, product_id, default=int(shown_qty or 1))
     
-    product = data.get_product(product_id)
+    product = await async_data.get_product(product_id)
     if not product:
-        await query.edit_message_text("Product not found.")
+        await query.answer()
+        await edit_message(query, "Product not found.")
         return
     
-    if int(product["stock"]) < qty:
+    # Hold the units before they go into the cart, so two shoppers can't both take the last one
+    user_id = update.effective_user.id
+    cart = await async_data.get_cart(user_id)
+    in_cart = cart["items"].get(product_id, {}).get("quantity", 0)
+    if not await async_data.run(stock_holds.set, user_id, product_id, in_cart + qty):
         await query.answer("Not enough stock available!", show_alert=True)
         return
     
-    user_id = update.effective_user.id
-    success = data.add_to_cart(user_id, product_id, qty)
+    success = await async_data.add_to_cart(user_id, product_id, qty)
     
     if success:
         await query.answer(f"Added {qty} × {product['name']} to your cart!", show_alert=True)
         
-        # Show updated product view with reset quantity
-        message = format_product_message(product)
-        markup = create_product_keyboard(product_id)
-        
-        await query.edit_message_text(message, reply_markup=markup, parse_mode='Markdown')
+        # Reset the card's quantity to 1, unless that is what its keyboard already shows
+        quantity_picker.reset(key)
+        if shown_qty not in ("", "1"):
+            _, markup = product_cards.get_or_render(
+                (product_id, product.get('version')), lambda: render_product_card(product)
+            )
+            await edit_reply_markup(query, markup)
     else:
+        await async_data.run(stock_holds.set, user_id, product_id, in_cart)
         await query.answer("Failed to add item to cart.", show_alert=True)
 
 async def view_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show the user's shopping cart."""
     user_id = update.effective_user.id
-    cart = data.get_cart(user_id)
+    cart = await async_data.get_cart(user_id)
     
     message = format_cart_message(cart)
     markup = create_cart_keyboard(cart)
@@ -216,19 +343,18 @@ async def view_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.callback_query:
         query = update.callback_query
         await query.answer()
-        await query.edit_message_text(message, reply_markup=markup, parse_mode='Markdown')
+        await edit_message(query, message, reply_markup=markup, parse_mode='Markdown')
     else:
         await update.message.reply_markdown(message, reply_markup=markup)
 
 async def update_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle cart updates (increase, decrease, remove item)."""
     query = update.callback_query
-    await query.answer()
     
     user_id = update.effective_user.id
     action, product_id = query.data.split("_")[1:]
     
-    cart = data.get_cart(user_id)
+    cart = await async_data.get_cart(user_id)
     if product_id not in cart["items"]:
         await query.answer("Item not found in cart.", show_alert=True)
         return
@@ -236,26 +362,25 @@ async def update_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     current_qty = cart["items"][product_id]["quantity"]
     
     if action == "increase":
-        # Check stock before increasing
-        product = data.get_product(product_id)
-        if int(product["stock"]) <= current_qty:
+        # Hold the extra unit first; this also checks it is in stock
+        if not await async_data.run(stock_holds.set, user_id, product_id, current_qty + 1):
             await query.answer("Maximum available stock reached.", show_alert=True)
             return
-        data.update_cart_item(user_id, product_id, current_qty + 1)
-    elif action == "decrease":
-        if current_qty > 1:
-            data.update_cart_item(user_id, product_id, current_qty - 1)
-        else:
-            data.update_cart_item(user_id, product_id, 0)  # Remove if qty would be 0
-    elif action == "remove":
-        data.update_cart_item(user_id, product_id, 0)  # Remove item
+        await async_data.update_cart_item(user_id, product_id, current_qty + 1)
+    elif action == "decrease" and current_qty > 1:
+        await async_data.run(stock_holds.set, user_id, product_id, current_qty - 1)
+        await async_data.update_cart_item(user_id, product_id, current_qty - 1)
+    elif action in ("decrease", "remove"):
+        await async_data.run(stock_holds.release, user_id, product_id)
+        await async_data.update_cart_item(user_id, product_id, 0)  # Remove item
+    await query.answer()
     
     # Refresh cart view
-    cart = data.get_cart(user_id)
+    cart = await async_data.get_cart(user_id)
     message = format_cart_message(cart)
     markup = create_cart_keyboard(cart)
     
-    await query.edit_message_text(message, reply_markup=markup, parse_mode='Markdown')
+    await edit_message(query, message, reply_markup=markup, parse_mode='Markdown')
 
 async def clear_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Clear the user's cart."""
@@ -263,14 +388,15 @@ async def clear_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     await query.answer()
     
     user_id = update.effective_user.id
-    data.clear_cart(user_id)
+    await async_data.run(stock_holds.release, user_id)
+    await async_data.clear_cart(user_id)
     
     # Refresh cart view
-    cart = data.get_cart(user_id)
+    cart = await async_data.get_cart(user_id)
     message = format_cart_message(cart)
     markup = create_cart_keyboard(cart)
     
-    await query.edit_message_text(message, reply_markup=markup, parse_mode='Markdown')
+    await edit_message(query, message, reply_markup=markup, parse_mode='Markdown')
 
 async def checkout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Start the checkout process."""
@@ -278,14 +404,14 @@ async def checkout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await query.answer()
     
     user_id = update.effective_user.id
-    cart = data.get_cart(user_id)
+    cart = await async_data.get_cart(user_id)
     
     if not cart["items"]:
         await query.answer("Your cart is empty.", show_alert=True)
         return
     
     # Ask for shipping address
-    await query.edit_message_text(
+    await edit_message(query, 
         "Please enter your shipping address:",
         reply_markup=InlineKeyboardMarkup([[
             InlineKeyboardButton("🔙 Cancel", callback_data="view_cart")
@@ -298,10 +424,10 @@ async def process_address(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Process the shipping address and ask for confirmation."""
     user_id = update.effective_user.id
     address = update.message.text
-    cart = data.get_cart(user_id)
+    cart = await async_data.get_cart(user_id)
     
     # Store address temporarily
-    user_data_store[user_id] = {"address": address}
+    conversations.set(f"address:{user_id}", address)
     
     # Show order summary and ask for confirmation
     message = "*Order Summary:*\n\n"
@@ -322,19 +448,47 @@ async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     await query.answer()
     
     user_id = update.effective_user.id
-    user_info = data.get_user(user_id)
-    address = user_data_store.get(user_id, {}).get("address", "")
+    user_info = await async_data.get_user(user_id)
+    address = conversations.get(f"address:{user_id}", "")
+    
+    # The address may have expired or been lost with a restart; ask for it again
+    if not address.strip():
+        await edit_message(query, 
+            "Your shipping address was not saved. Please enter it again:",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Cancel", callback_data="view_cart")
+            ]])
+        )
+        return ADDRESS
+    
+    # Turn the cart's stock holds into sold stock, or stop if something ran out meanwhile
+    cart = await async_data.get_cart(user_id)
+    quantities = {product_id: item["quantity"] for product_id, item in cart["items"].items()}
+    if not quantities or not await async_data.run(stock_holds.checkout, user_id, quantities, decrement_stock):
+        await edit_message(
+            query,
+            "Sorry, some items in your cart are no longer available in that quantity.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🛒 View Cart", callback_data="view_cart")
+            ]])
+        )
+        return ConversationHandler.END
     
-    # Create the order
-    order_id = data.create_order(user_id, user_info, address)
+    # Create the order, putting the sold stock back if that fails
+    try:
+        order_id = await async_data.create_order(user_id, user_info, address)
+    except Exception as e:
+        logger.error(f"Failed to create order for user {user_id}: {e}")
+        order_id = None
+    if not order_id:
+        await async_data.run(restock, quantities)
     
     if order_id:
         # Clean up temporary data
-        if user_id in user_data_store:
-            del user_data_store[user_id]
+        conversations.pop(f"address:{user_id}")
         
         # Show success message
-        order = data.get_order(order_id)
+        order = await async_data.get_order(order_id)
         message = "🎉 *Your order has been placed!*\n\n"
         message += format_order_message(order)
         
@@ -342,12 +496,12 @@ async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
             InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
         ]])
         
-        await query.edit_message_text(message, reply_markup=markup, parse_mode='Markdown')
+        await edit_message(query, message, reply_markup=markup, parse_mode='Markdown')
         
         # Also notify via utils function for reference
         await send_order_notification(context, user_id, order_id, format_order_message(order))
     else:
-        await query.edit_message_text(
+        await edit_message(query, 
             "Failed to create your order. Please try again.",
             reply_markup=InlineKeyboardMarkup([[
                 InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
@@ -364,10 +518,10 @@ async def cancel_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     user_id = update.effective_user.id
     
     # Clean up temporary data
-    if user_id in user_data_store:
-        del user_data_store[user_id]
+    conversations.pop(f"address:{user_id}")
+    await async_data.run(stock_holds.release, user_id)
     
-    await query.edit_message_text(
+    await edit_message(query, 
         "Order cancelled. Your cart is still available.",
         reply_markup=InlineKeyboardMarkup([[
             InlineKeyboardButton("🛒 View Cart", callback_data="view_cart"),
@@ -390,7 +544,7 @@ async def view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         page = 1
     
     user_id = update.effective_user.id
-    user_orders = data.get_user_orders(user_id)
+    user_orders = await async_data.get_user_orders(user_id)
     orders_list = list(user_orders.values())
     
     if not orders_list:
@@ -401,7 +555,7 @@ async def view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         ]])
         
         if query:
-            await query.edit_message_text(message, reply_markup=markup)
+            await edit_message(query, message, reply_markup=markup)
         else:
             await update.message.reply_text(message, reply_markup=markup)
         return
@@ -443,7 +597,7 @@ async def view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     markup = InlineKeyboardMarkup(keyboard)
     
     if query:
-        await query.edit_message_text(message, reply_markup=markup, parse_mode='Markdown')
+        await edit_message(query, message, reply_markup=markup, parse_mode='Markdown')
     else:
         await update.message.reply_markdown(message, reply_markup=markup)
 
@@ -453,10 +607,10 @@ async def view_order_details(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     
     order_id = query.data.split("_")[-1]
-    order = data.get_order(order_id)
+    order = await async_data.get_order(order_id)
     
     if not order:
-        await query.edit_message_text("Order not found.")
+        await edit_message(query, "Order not found.")
         return
     
     message = format_order_message(order)
@@ -466,7 +620,7 @@ async def view_order_details(update: Update, context: ContextTypes.DEFAULT_TYPE)
         InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
     ]])
     
-    await query.edit_message_text(message, reply_markup=markup, parse_mode='Markdown')
+    await edit_message(query, message, reply_markup=markup, parse_mode='Markdown')
 
 async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show the main menu."""
@@ -481,7 +635,7 @@ async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         [InlineKeyboardButton("📦 My Orders", callback_data="my_orders_1")]
     ]
     
-    await query.edit_message_text(
+    await edit_message(query, 
         f"Welcome, {html.escape(user.first_name)}! 👋\n\n"
         f"This is an e-commerce bot where you can browse and purchase products.\n\n"
         f"Use the buttons below to navigate:",
@@ -493,10 +647,67 @@ async def noop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     query = update.callback_query
     await query.answer()
 
+async def broadcast_chat_ids():
+    """Chat ids of every user who has talked to the bot; web-only accounts have no chat."""
+    users = await async_data.get_all_users()
+    return [int(user_id) for user_id, user in users.items() if 'password_hash' not in user]
+
+async def start_outbox(application: Application) -> None:
+    """Start the outgoing message queue and the broadcast job watcher."""
+    outbox = Outbox(
+        application.bot,
+        rate=OUTBOX_RATE,
+        chat_rate=OUTBOX_CHAT_RATE,
+        group_per_minute=OUTBOX_GROUP_PER_MINUTE,
+        max_pending=OUTBOX_MAX_PENDING
+    )
+    outbox.start()
+    application.bot_data["outbox"] = outbox
+    application.bot_data["broadcasts"] = asyncio.create_task(
+        watch_broadcasts(outbox, BROADCASTS_DIR, broadcast_chat_ids, BROADCAST_POLL_SECONDS)
+    )
+
+async def stop_outbox(application: Application) -> None:
+    """Stop the broadcast job watcher and the outgoing message queue."""
+    watcher = application.bot_data.pop("broadcasts", None)
+    if watcher is not None:
+        watcher.cancel()
+    outbox = application.bot_data.pop("outbox", None)
+    if outbox is not None:
+        await outbox.stop()
+
+def log_render_stats() -> None:
+    """Log how much rendering and editing the caches saved."""
+    logger.info(
+        f"Catalog pages: {catalog_pages.hits} hits / {catalog_pages.misses} misses, "
+        f"product cards: {product_cards.hits} hits / {product_cards.misses} misses, "
+        f"message edits: {rendered_messages.skipped} skipped / {rendered_messages.sent} sent "
+        f"({rendered_messages.hit_rate():.0%} saved), "
+        f"quantity taps: {quantity_picker.taps}, keyboard edits: {quantity_picker.edits}"
+    )
+
+async def post_stop(application: Application) -> None:
+    """Shut down background senders and report cache statistics."""
+    await stop_outbox(application)
+    log_render_stats()
+    logger.info(f"Stock holds: {stock_holds.stats()}")
+
 def create_bot_application():
     """Create and configure the bot application."""
     # Create the application
-    application = Application.builder().token(TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .post_init(start_outbox)
+        .post_stop(post_stop)
+        .persistence(ConversationPersistence(conversations, update_interval=CONVERSATION_FLUSH_SECONDS))
+    )
+    if BOT_CONCURRENT_UPDATES > 1:
+        # Parallel across users, sequential per user
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES))
+    application = builder.build()
     
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
@@ -504,6 +715,10 @@ def create_bot_application():
     application.add_handler(CommandHandler("browse", browse_products))
     application.add_handler(CommandHandler("cart", view_cart))
     application.add_handler(CommandHandler("orders", view_orders))
+    application.add_handler(CommandHandler("search", search_command))
+    
+    # Inline mode: @bot <words> searches the catalog from any chat
+    application.add_handler(InlineQueryHandler(inline_search))
     
     # Add conversation handler for checkout process
     checkout_conv_handler = ConversationHandler(
@@ -516,6 +731,10 @@ def create_bot_application():
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel_order)],
+        name="checkout",
+        persistent=True,
+        # Abandoned checkouts end instead of being remembered forever
+        conversation_timeout=CONVERSATION_TTL_SECONDS,
     )
     application.add_handler(checkout_conv_handler)
     
@@ -539,4 +758,13 @@ if __name__ == "__main__":
     bot_application = create_bot_application()
     
     # Run the bot
-    bot_application.run_polling()
+    if BOT_MODE == "webhook":
+        import secrets
+        from webhook import run_webhook
+        
+        if not WEBHOOK_URL:
+            raise SystemExit("BOT_MODE=webhook needs WEBHOOK_URL")
+        secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        run_webhook(bot_application, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, secret)
+    else:
+        bot_application.run_polling()
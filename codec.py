@@ -0,0 +1,88 @@
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# First bytes a JSON document can start with; anything else is treated as msgpack
+JSON_START = frozenset(b'{["-0123456789tfn \t\r\n')
+
+
+class JsonCodec:
+    """JSON, encoded with orjson when it is installed and the stdlib otherwise."""
+
+    binary = False
+
+    def __init__(self, pretty=False, fast=True):
+        self.pretty = pretty
+        self.fast = fast and orjson is not None
+        self.name = "orjson" if self.fast else "json"
+        if pretty:
+            self.name += "-pretty"
+
+    def dumps(self, data):
+        if self.fast:
+            return orjson.dumps(data, option=orjson.OPT_INDENT_2 if self.pretty else 0)
+        if self.pretty:
+            return json.dumps(data, indent=4).encode()
+        return json.dumps(data, separators=(',', ':')).encode()
+
+    def loads(self, raw):
+        if self.fast:
+            return orjson.loads(raw)
+        return json.loads(raw)
+
+
+class MsgpackCodec:
+    """Binary MessagePack, for snapshots nobody needs to read by hand."""
+
+    binary = True
+    name = "msgpack"
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+def get_codec(name, pretty=False):
+    """Return the codec called name, falling back to JSON if its library is missing.
+
+    ``json`` uses orjson when available, ``stdjson`` always uses the standard
+    library, and ``msgpack`` needs the msgpack package.
+    """
+    if name == "msgpack":
+        if msgpack is not None:
+            return MsgpackCodec()
+        logger.warning("msgpack is not installed, storing data as JSON")
+    elif name == "stdjson":
+        return JsonCodec(pretty=pretty, fast=False)
+    elif name != "json":
+        logger.warning(f"Unknown data codec {name!r}, storing data as JSON")
+    return JsonCodec(pretty=pretty)
+
+
+_json = JsonCodec()
+_msgpack = MsgpackCodec()
+
+def decode(raw):
+    """Decode bytes written by any codec, telling JSON and msgpack apart by the first byte.
+
+    Files written with one codec therefore stay readable after switching to
+    another. Undecodable input raises ValueError.
+    """
+    if not raw or raw[0] in JSON_START:
+        return _json.loads(raw)
+    if msgpack is None:
+        raise ValueError("data is not JSON and msgpack is not installed")
+    return _msgpack.loads(raw)
@@ -4,8 +4,48 @@ import logging
 # Telegram bot token
 TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
 
+# Updates from different users handled at the same time; each user's updates stay in order.
+# 1 processes every update one after another.
+BOT_CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", "16"))
+
+# Bot API server; point it at a local server (or a fake one in tests) to bypass api.telegram.org
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+
+# How the bot receives updates: "polling", or "webhook" to have Telegram push them to
+# WEBHOOK_URL. The listener binds WEBHOOK_LISTEN:WEBHOOK_PORT and serves the URL's path;
+# Telegram must send WEBHOOK_SECRET with every update (a random one is made if unset).
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+
+# Outgoing message limits (Telegram allows about 30/s overall, 1/s per chat, 20/min per group).
+# At most OUTBOX_MAX_PENDING broadcast messages are queued at once.
+OUTBOX_RATE = float(os.environ.get("OUTBOX_RATE", "30"))
+OUTBOX_CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_GROUP_PER_MINUTE = float(os.environ.get("OUTBOX_GROUP_PER_MINUTE", "20"))
+OUTBOX_MAX_PENDING = int(os.environ.get("OUTBOX_MAX_PENDING", "1000"))
+
+# Quiet time after the last ➕/➖ tap before a product card's keyboard is updated
+QUANTITY_EDIT_DELAY_MS = int(os.environ.get("QUANTITY_EDIT_DELAY_MS", "700"))
+
+# How long stock put into a cart stays held for that shopper without further activity
+STOCK_HOLD_SECONDS = int(os.environ.get("STOCK_HOLD_SECONDS", "900"))
+
+# Rendered catalog pages and product cards kept per cache
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "2048"))
+# Total size of the rendered admin pages kept in memory
+PAGE_CACHE_BYTES = int(os.environ.get("PAGE_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+# Products written per transaction by the bulk import
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "5000"))
+
 # Flask app settings
 DEBUG = True
+
+# Production mode trades human-readable data files for speed
+PRODUCTION = os.environ.get("PRODUCTION", "").lower() in ("1", "true", "yes")
 HOST = "0.0.0.0"
 PORT = 5000
 
@@ -14,7 +54,59 @@ DATA_DIR = "data"
 PRODUCTS_FILE = os.path.join(DATA_DIR, "products.json")
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
 ORDERS_FILE = os.path.join(DATA_DIR, "orders.json")
+ORDERS_DIR = os.path.join(DATA_DIR, "orders")
+# Monthly order segments kept in memory for order lookups, least recently used dropped first
+ORDER_SEGMENTS_CACHED = int(os.environ.get("ORDER_SEGMENTS_CACHED", "12"))
 CARTS_FILE = os.path.join(DATA_DIR, "carts.json")
+CARTS_LOG_FILE = os.path.join(DATA_DIR, "carts.log")
+CARTS_DIR = os.path.join(DATA_DIR, "carts")
+# Dashboard counters, kept up to date by every write
+STATS_FILE = os.path.join(DATA_DIR, "stats.json")
+
+# Serialization of data files: "json" (orjson when installed) or "stdjson". Files are
+# indented outside production. Cart snapshots may also use "msgpack"; the format of an
+# existing file is detected when it is read, so switching codecs needs no migration.
+DATA_CODEC = os.environ.get("DATA_CODEC", "json")
+SNAPSHOT_CODEC = os.environ.get("SNAPSHOT_CODEC", DATA_CODEC)
+
+# Write-behind window in milliseconds. 0 writes every change straight to disk; above 0,
+# changes are applied in memory and each changed file is written once per window.
+# Only enable it when a single process writes the data files.
+WRITE_BEHIND_MS = int(os.environ.get("WRITE_BEHIND_MS", "0"))
+
+# Threads the bot uses for storage calls, keeping disk I/O off the event loop
+DATA_THREADS = int(os.environ.get("DATA_THREADS", "8"))
+
+# Admin announcements waiting to be sent by the bot, and how often the bot checks for them
+BROADCASTS_DIR = os.path.join(DATA_DIR, "broadcasts")
+BROADCAST_POLL_SECONDS = int(os.environ.get("BROADCAST_POLL_SECONDS", "5"))
+
+# Checkout progress (conversation states, entered addresses), saved so restarts don't drop it.
+# Entries expire after CONVERSATION_TTL_SECONDS without activity and at most
+# CONVERSATION_MAX_ENTRIES are kept; changes reach the file within CONVERSATION_FLUSH_SECONDS.
+CONVERSATIONS_FILE = os.path.join(DATA_DIR, "conversations.json")
+CONVERSATION_TTL_SECONDS = int(os.environ.get("CONVERSATION_TTL_SECONDS", "3600"))
+CONVERSATION_MAX_ENTRIES = int(os.environ.get("CONVERSATION_MAX_ENTRIES", "10000"))
+CONVERSATION_FLUSH_SECONDS = int(os.environ.get("CONVERSATION_FLUSH_SECONDS", "5"))
+
+# Persistent id counters
+PRODUCTS_SEQ_FILE = os.path.join(DATA_DIR, "products.seq")
+USERS_SEQ_FILE = os.path.join(DATA_DIR, "users.seq")
+ORDERS_SEQ_FILE = os.path.join(DATA_DIR, "orders.seq")
+
+# Number of journaled cart changes after which the log is folded into carts.json
+CART_LOG_COMPACT_OPS = int(os.environ.get("CART_LOG_COMPACT_OPS", "1000"))
+
+# Carts are spread over this many shard files; only used when CARTS_DIR is first created
+CART_SHARDS = int(os.environ.get("CART_SHARDS", "64"))
+# Cart shards not touched for this long are dropped from memory
+CART_SHARD_IDLE_SECONDS = int(os.environ.get("CART_SHARD_IDLE_SECONDS", "600"))
+
+# Storage backend: "json" for the files in DATA_DIR, "sql" for DATABASE_URL
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///" + os.path.join(DATA_DIR, "shop.db"))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
 
 # Admin credentials
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME", "admin")
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from codec import decode
+from store import PRETTY_JSON, write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationStore:
+    """Short-lived per-user state (checkout steps, entered addresses) with a TTL and a size cap.
+
+    Entries expire ``ttl`` seconds after they were last written, and once
+    ``max_entries`` are held the least recently used one is evicted, so users
+    who walk away halfway through a checkout no longer pile up in memory.
+
+    The store lives in memory and is written to ``file_path`` as a single
+    snapshot, at most every ``flush_interval`` seconds and only after a
+    change, by a background thread (and on exit). A restart therefore picks up
+    in-flight checkouts, losing at most the last interval's changes.
+    """
+
+    def __init__(self, file_path, ttl=86400, max_entries=10000, flush_interval=5, codec=PRETTY_JSON):
+        self.file_path = file_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.codec = codec
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._load()
+        if flush_interval:
+            thread = threading.Thread(target=self._flush_loop, args=(flush_interval,), name="conversations", daemon=True)
+            thread.start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the value stored under key, or default if there is none or it has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.time():
+                self._expire(key)
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        """Store a JSON-serializable value under key, restarting its TTL."""
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._dirty = True
+
+    def pop(self, key, default=None):
+        """Remove key and return its value."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self._dirty = True
+            return entry[1] if entry[0] > time.time() else default
+
+    def items(self, prefix=""):
+        """Return (key, value) for every live entry whose key starts with prefix."""
+        with self._lock:
+            self._expire_all()
+            return [(key, entry[1]) for key, entry in self._entries.items() if key.startswith(prefix)]
+
+    def stats(self):
+        """Return counters for monitoring: live entries, evictions by the size cap and TTL expirations."""
+        return {"live": len(self._entries), "evictions": self.evictions, "expirations": self.expirations}
+
+    def flush(self):
+        """Write the store to disk if it changed since the last flush."""
+        # Serialize flushes so an older snapshot never replaces a newer one
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._expire_all()
+                snapshot = {key: list(entry) for key, entry in self._entries.items()}
+                self._dirty = False
+            write_atomic(self.file_path, snapshot, self.codec)
+        logger.debug(f"Conversation state saved: {self.stats()}")
+
+    def _expire(self, key):
+        del self._entries[key]
+        self.expirations += 1
+        self._dirty = True
+
+    def _expire_all(self):
+        now = time.time()
+        for key in [key for key, entry in self._entries.items() if entry[0] <= now]:
+            self._expire(key)
+
+    def _load(self):
+        if not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path, 'rb') as f:
+                snapshot = decode(f.read())
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read conversation state from {self.file_path}: {e}")
+            return
+        now = time.time()
+        # Least recently used first, as they were written
+        for key, (expires_at, value) in snapshot.items():
+            if expires_at > now:
+                self._entries[key] = (expires_at, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        logger.info(f"Loaded {len(self._entries)} conversation entries from {self.file_path}")
+
+    def _flush_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to save conversation state: {e}")
+
+
+class ConversationPersistence(BasePersistence):
+    """Keeps ConversationHandler states in a ConversationStore, and nothing else.
+
+    User, chat and bot data are not persisted; state the bot needs to keep
+    goes into the store explicitly.
+    """
+
+    def __init__(self, store, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.store = store
+
+    @staticmethod
+    def _prefix(name):
+        return f"conversation:{name}:"
+
+    async def get_conversations(self, name):
+        prefix = self._prefix(name)
+        return {tuple(json.loads(key[len(prefix):])): state for key, state in self.store.items(prefix)}
+
+    async def update_conversation(self, name, key, new_state):
+        store_key = self._prefix(name) + json.dumps(list(key))
+        if new_state is None:
+            self.store.pop(store_key)
+        else:
+            self.store.set(store_key, new_state)
+
+    async def flush(self):
+        self.store.flush()
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
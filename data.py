@@ -1,29 +1,97 @@
-import json
-import os
+import atexit
 import logging
 from datetime import datetime
-from config import PRODUCTS_FILE, USERS_FILE, ORDERS_FILE, CARTS_FILE
+from config import (
+    PRODUCTS_FILE, USERS_FILE, ORDERS_FILE, ORDERS_DIR, CARTS_FILE, CARTS_LOG_FILE, CARTS_DIR, STATS_FILE,
+    ORDER_SEGMENTS_CACHED,
+    CART_LOG_COMPACT_OPS, CART_SHARDS, CART_SHARD_IDLE_SECONDS,
+    PRODUCTS_SEQ_FILE, USERS_SEQ_FILE, ORDERS_SEQ_FILE, STORAGE_BACKEND,
+    PRODUCTION, DATA_CODEC, SNAPSHOT_CODEC, WRITE_BEHIND_MS
+)
+from aggregates import Aggregates, count, count_order, empty_stats
+from codec import get_codec
+from journal import ShardedCartStore
+from order_store import OrderStore
+from search import SearchIndex
+from sequences import Sequence, max_numeric_id
+from store import JsonStore, Rollback
 
 logger = logging.getLogger(__name__)
 
+# Parsed data files stay resident; reads only re-parse a file after it changes on disk
+_store = JsonStore(
+    codec=get_codec(DATA_CODEC, pretty=not PRODUCTION),
+    write_behind=WRITE_BEHIND_MS / 1000
+)
+# Don't lose write-behind changes still waiting for the flusher
+atexit.register(_store.commit)
+
+# Carts are sharded by user id, and each shard journals its changes instead of rewriting per tap
+_carts = ShardedCartStore(
+    CARTS_DIR,
+    shards=CART_SHARDS,
+    compact_after=CART_LOG_COMPACT_OPS,
+    idle_seconds=CART_SHARD_IDLE_SECONDS,
+    legacy_snapshot=CARTS_FILE,
+    legacy_log=CARTS_LOG_FILE,
+    codec=get_codec(SNAPSHOT_CODEC, pretty=not PRODUCTION)
+)
+
+# Orders live in monthly segments with an id -> segment index
+_orders = OrderStore(ORDERS_DIR, _store, legacy_file=ORDERS_FILE, max_segments=ORDER_SEGMENTS_CACHED)
+
+# Id counters, seeded once from the highest id already stored
+_product_ids = Sequence(PRODUCTS_SEQ_FILE, seed=lambda: max_numeric_id(load_json(PRODUCTS_FILE)))
+_user_ids = Sequence(USERS_SEQ_FILE, seed=lambda: max_numeric_id(load_json(USERS_FILE)))
+_order_ids = Sequence(ORDERS_SEQ_FILE, seed=lambda: max_numeric_id(_orders.index()))
+
+# Word index over product names and descriptions, patched by every product write
+_search = SearchIndex()
+
+# Dashboard counters, updated under their own lock around every counted write. They
+# are written straight through, never batched, so concurrent writers never merge them.
+_stats = Aggregates(
+    STATS_FILE, JsonStore(codec=_store.codec), seed=lambda: _count_everything(), durable=_store.commit
+)
+
 def load_json(file_path):
     """Load data from a JSON file or return empty dict if file doesn't exist."""
-    if os.path.exists(file_path):
-        try:
-            with open(file_path, 'r') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            logger.error(f"Error decoding JSON from {file_path}")
-            return {}
-    else:
-        # Create the file with an empty structure
-        save_json(file_path, {})
-        return {}
+    return _store.load(file_path)
 
 def save_json(file_path, data):
-    """Save data to a JSON file."""
-    with open(file_path, 'w') as f:
-        json.dump(data, f, indent=4)
+    """Save data to a JSON file, replacing it atomically."""
+    _store.save(file_path, data)
+
+def commit():
+    """Wait until every change made so far is on disk (only needed with write-behind)."""
+    _store.commit()
+
+def _count_everything():
+    stats = empty_stats()
+    stats["products"] = len(get_all_products())
+    stats["users"] = len(get_all_users())
+    for order_id, entry in _orders.index().items():
+        stats["orders"] += 1
+        count_order(stats, order_id, entry["status"], entry["total"])
+    return stats
+
+def get_stamp(entity, entity_id=None):
+    """Get (tag, modified) validators for "products", "orders" or one "order".
+
+    The tag changes whenever the data behind it changes; modified is a Unix
+    time, or None when unknown. Returns None for an order that doesn't exist.
+    """
+    if entity == "products":
+        return _store.stamp(PRODUCTS_FILE)
+    if entity == "orders":
+        return _orders.stamp()
+    if entity == "order":
+        return _orders.stamp(entity_id)
+    raise ValueError(f"No stamp for {entity!r}")
+
+def get_dashboard_stats():
+    """Get the entity counts, order count and revenue per status, and pending order ids."""
+    return _stats.get()
 
 # Product Management
 def get_all_products():
@@ -38,34 +106,130 @@ def get_product(product_id):
 
 def add_product(product_data):
     """Add a new product."""
-    products = get_all_products()
-    product_id = str(len(products) + 1)  # Simple ID generation
-    product_data['id'] = product_id
-    product_data['created_at'] = datetime.now().isoformat()
-    products[product_id] = product_data
-    save_json(PRODUCTS_FILE, products)
+    with _stats.change() as stats:
+        with _store.transaction(PRODUCTS_FILE) as products:
+            product_id = _product_ids.next()
+            while product_id in products:  # skip ids taken outside the sequence
+                product_id = _product_ids.next()
+            product_data['id'] = product_id
+            product_data['version'] = 1
+            product_data['created_at'] = datetime.now().isoformat()
+            _search_index().add(product_id, product_data)
+            products[product_id] = product_data
+        count(stats, "products")
     return product_id
 
+def upsert_products(products):
+    """Add or update many products in one write; returns the (created, updated) counts.
+
+    A product whose id is already stored updates it, keeping the fields it
+    leaves out. The others are added, under their own id if they have one,
+    with PRODUCT_DEFAULTS for the optional fields they leave out.
+    """
+    from models import PRODUCT_DEFAULTS
+
+    now = datetime.now().isoformat()
+    created = updated = 0
+    with _stats.change() as stats:
+        with _store.transaction(PRODUCTS_FILE) as stored:
+            search = _search_index()
+            new_ids = iter(_product_ids.reserve(sum(1 for p in products if not p.get('id'))))
+            for product_data in products:
+                product_id = product_data.get('id')
+                if product_id and product_id in stored:
+                    product = dict(stored[product_id], **product_data)
+                    product['version'] = stored[product_id].get('version', 0) + 1
+                    product['updated_at'] = now
+                    updated += 1
+                else:
+                    if not product_id:
+                        product_id = next(new_ids)
+                        while product_id in stored:  # skip ids taken outside the sequence
+                            product_id = _product_ids.next()
+                    product = {**PRODUCT_DEFAULTS, **product_data, 'id': product_id, 'version': 1, 'created_at': now}
+                    created += 1
+                search.add(product_id, product)
+                stored[product_id] = product
+        count(stats, "products", created)
+    return created, updated
+
 def update_product(product_id, product_data):
     """Update an existing product."""
-    products = get_all_products()
-    if product_id in products:
+    with _store.transaction(PRODUCTS_FILE) as products:
+        if product_id not in products:
+            raise Rollback
         product_data['id'] = product_id
+        product_data['version'] = products[product_id].get('version', 0) + 1
         product_data['updated_at'] = datetime.now().isoformat()
+        _search_index().add(product_id, product_data)
         products[product_id] = product_data
-        save_json(PRODUCTS_FILE, products)
         return True
     return False
 
 def delete_product(product_id):
     """Delete a product."""
-    products = get_all_products()
-    if product_id in products:
-        del products[product_id]
-        save_json(PRODUCTS_FILE, products)
+    if product_id not in get_all_products():
+        return False
+    deleted = False
+    with _stats.change() as stats:
+        with _store.transaction(PRODUCTS_FILE) as products:
+            if product_id not in products:
+                raise Rollback
+            _search_index().remove(product_id)
+            del products[product_id]
+            deleted = True
+        if deleted:
+            count(stats, "products", -1)
+    return deleted
+
+def get_stock(product_id):
+    """Get a product's stock, or None if the product doesn't exist."""
+    product = get_product(str(product_id))
+    return int(product['stock']) if product else None
+
+def decrement_stock(quantities):
+    """Take sold quantities ({product_id: quantity}) out of stock, for all products or none."""
+    with _store.transaction(PRODUCTS_FILE) as products:
+        for product_id, quantity in quantities.items():
+            product = products.get(str(product_id))
+            if product is None or int(product['stock']) < quantity:
+                raise Rollback
+        for product_id, quantity in quantities.items():
+            product = products[str(product_id)]
+            product['stock'] = int(product['stock']) - quantity
+            product['version'] = product.get('version', 0) + 1
         return True
     return False
 
+def restock(quantities):
+    """Put quantities ({product_id: quantity}) back into stock, e.g. for an order that failed after decrement_stock."""
+    with _store.transaction(PRODUCTS_FILE) as products:
+        for product_id, quantity in quantities.items():
+            product = products.get(str(product_id))
+            if product is not None:
+                product['stock'] = int(product['stock']) + quantity
+                product['version'] = product.get('version', 0) + 1
+
+def get_catalog_version():
+    """Get a number that changes whenever any product is added, edited or deleted."""
+    return _store.version(PRODUCTS_FILE)
+
+def _search_index():
+    """The search index, synced when the products file is re-read and patched by every product write.
+
+    Stock changes don't touch the words, so they leave it as it is.
+    """
+    def build(products):
+        _search.sync(products)
+        return _search
+    return _store.index(PRODUCTS_FILE, 'search', build)
+
+def search_products(query, limit=20):
+    """Search products by the words in their name and description."""
+    search = _search_index()
+    products = get_all_products()
+    return [products[product_id] for product_id in search.search(query, limit) if product_id in products]
+
 # User Management
 def get_all_users():
     """Get all users."""
@@ -79,121 +243,119 @@ def get_user(user_id):
         return user_data
     return None
 
+def _users_by(field):
+    """Index of user ids by username or email, kept in step with every user write."""
+    def build(users):
+        index = {}
+        for user_id, user_data in users.items():
+            value = user_data.get(field)
+            if value is not None:
+                index.setdefault(value, []).append(user_id)
+        return index
+    return _store.index(USERS_FILE, field, build)
+
+def _reindex_user(user_id, old_data, new_data):
+    """Move a user's entries in the username and email indexes from old_data to new_data."""
+    for field in ('username', 'email'):
+        index = _users_by(field)
+        old_value = old_data.get(field) if old_data else None
+        new_value = new_data.get(field)
+        if old_value == new_value and old_data:
+            continue
+        if old_value is not None and user_id in index.get(old_value, ()):
+            index[old_value].remove(user_id)
+            if not index[old_value]:
+                del index[old_value]
+        if new_value is not None:
+            index.setdefault(new_value, []).append(user_id)
+
+def _get_user_by(field, value):
+    user_ids = _users_by(field).get(value)
+    if not user_ids:
+        return None
+    return get_all_users().get(user_ids[0])
+
 def get_user_by_username(username):
     """Get a user by username."""
-    users = get_all_users()
-    for user_id, user_data in users.items():
-        if user_data.get('username') == username:
-            return user_data
-    return None
+    return _get_user_by('username', username)
 
 def get_user_by_email(email):
     """Get a user by email."""
-    users = get_all_users()
-    for user_id, user_data in users.items():
-        if user_data.get('email') == email:
-            return user_data
-    return None
+    return _get_user_by('email', email)
 
 def add_or_update_user(user_id, user_data):
     """Add or update a user."""
-    users = get_all_users()
-    users[str(user_id)] = user_data
-    save_json(USERS_FILE, users)
-    return str(user_id)
+    user_id = str(user_id)
+
+    def write():
+        with _store.transaction(USERS_FILE) as users:
+            is_new = user_id not in users
+            _reindex_user(user_id, users.get(user_id), user_data)
+            users[user_id] = user_data
+        return is_new
+
+    # Only a new user changes the counters; returning ones skip their lock
+    if user_id in get_all_users():
+        write()
+        return user_id
+    with _stats.change() as stats:
+        if write():
+            count(stats, "users")
+    return user_id
 
 def create_user(username, email, password):
     """Create a new user with password."""
-    # Check if username or email already exists
-    if get_user_by_username(username) or get_user_by_email(email):
-        return None
-        
-    users = get_all_users()
-    # Generate a unique ID
-    if users:
-        user_id = str(max(int(id) for id in users.keys()) + 1)
-    else:
-        user_id = "1"
-    
-    # Create user with password hash
     from models import User
-    user = User(id=user_id, username=username, email=email)
-    user.set_password(password)
     
-    # Save user to storage
-    users[user_id] = user.to_dict()
-    save_json(USERS_FILE, users)
+    with _stats.change() as stats:
+        user_id = None
+        with _store.transaction(USERS_FILE) as users:
+            # Check if username or email already exists
+            if get_user_by_username(username) or get_user_by_email(email):
+                raise Rollback
+        
+            user_id = _user_ids.next()
+            while user_id in users:  # skip ids taken outside the sequence
+                user_id = _user_ids.next()
+        
+            # Create user with password hash
+            user = User(id=user_id, username=username, email=email)
+            user.set_password(password)
+        
+            # Save user to storage
+            _reindex_user(user_id, None, user.to_dict())
+            users[user_id] = user.to_dict()
+        if user_id is not None:
+            count(stats, "users")
     
     return user_id
 
 # Cart Management
 def get_cart(user_id):
     """Get a user's shopping cart."""
-    carts = load_json(CARTS_FILE)
-    return carts.get(str(user_id), {"items": {}, "total": 0})
+    return _carts.get(user_id)
 
 def add_to_cart(user_id, product_id, quantity=1):
     """Add a product to a user's cart."""
-    carts = load_json(CARTS_FILE)
-    user_id = str(user_id)
-    product_id = str(product_id)
-    
-    if user_id not in carts:
-        carts[user_id] = {"items": {}, "total": 0}
-    
-    product = get_product(product_id)
+    product = get_product(str(product_id))
     if not product:
         return False
     
-    if product_id in carts[user_id]["items"]:
-        carts[user_id]["items"][product_id]["quantity"] += quantity
-    else:
-        carts[user_id]["items"][product_id] = {
-            "product_name": product["name"],
-            "price": product["price"],
-            "quantity": quantity
-        }
-    
-    # Recalculate total
-    total = 0
-    for item in carts[user_id]["items"].values():
-        total += item["price"] * item["quantity"]
-    carts[user_id]["total"] = total
-    
-    save_json(CARTS_FILE, carts)
+    _carts.add_item(user_id, product_id, product["name"], product["price"], quantity)
     return True
 
 def update_cart_item(user_id, product_id, quantity):
     """Update the quantity of a product in a user's cart."""
-    carts = load_json(CARTS_FILE)
-    user_id = str(user_id)
-    product_id = str(product_id)
-    
-    if user_id not in carts or product_id not in carts[user_id]["items"]:
+    cart = get_cart(user_id)
+    if str(product_id) not in cart["items"]:
         return False
     
-    if quantity <= 0:
-        del carts[user_id]["items"][product_id]
-    else:
-        carts[user_id]["items"][product_id]["quantity"] = quantity
-    
-    # Recalculate total
-    total = 0
-    for item in carts[user_id]["items"].values():
-        total += item["price"] * item["quantity"]
-    carts[user_id]["total"] = total
-    
-    save_json(CARTS_FILE, carts)
+    _carts.set_quantity(user_id, product_id, quantity)
     return True
 
 def clear_cart(user_id):
     """Clear a user's cart."""
-    carts = load_json(CARTS_FILE)
-    user_id = str(user_id)
-    
-    if user_id in carts:
-        carts[user_id] = {"items": {}, "total": 0}
-        save_json(CARTS_FILE, carts)
+    _carts.clear(user_id)
     return True
 
 # Order Management
@@ -203,8 +365,9 @@ def create_order(user_id, user_data, address):
     if not cart["items"]:
         return None
     
-    orders = load_json(ORDERS_FILE)
-    order_id = str(len(orders) + 1)  # Simple ID generation
+    order_id = _order_ids.next()
+    while order_id in _orders.index():  # skip ids taken outside the sequence
+        order_id = _order_ids.next()
     
     order = {
         "id": order_id,
@@ -216,9 +379,11 @@ def create_order(user_id, user_data, address):
         "status": "pending",
         "created_at": datetime.now().isoformat()
     }
-    
-    orders[order_id] = order
-    save_json(ORDERS_FILE, orders)
+    # Committed on the way out of the counters' lock, so orders survive a crash even when writes are batched
+    with _stats.change() as stats:
+        _orders.add(order)
+        count(stats, "orders")
+        count_order(stats, order_id, "pending", order["total"])
     
     # Clear the cart after creating the order
     clear_cart(user_id)
@@ -227,28 +392,66 @@ def create_order(user_id, user_data, address):
 
 def get_order(order_id):
     """Get an order by ID."""
-    orders = load_json(ORDERS_FILE)
-    return orders.get(str(order_id))
+    return _orders.get(order_id)
 
 def get_user_orders(user_id):
     """Get all orders for a user."""
-    orders = load_json(ORDERS_FILE)
     user_orders = {}
-    for order_id, order in orders.items():
-        if order["user_id"] == str(user_id):
-            user_orders[order_id] = order
+    for order_id in _orders.user_order_ids(user_id):
+        user_orders[order_id] = _orders.get(order_id)
     return user_orders
 
 def get_all_orders():
     """Get all orders."""
-    return load_json(ORDERS_FILE)
+    return _orders.all()
+
+def iter_orders(newest_first=False, status=None, date_from=None, date_to=None):
+    """Yield all orders one at a time, reading the history a month at a time.
+
+    Optionally only orders with a status, or created between two inclusive
+    "YYYY-MM-DD" dates.
+    """
+    orders = _orders.iter(newest_first=newest_first, created_from=date_from, created_to=date_to)
+    if status:
+        return (order for order in orders if order.get("status") == status)
+    return orders
+
+def get_orders_page(page=1, per_page=50, status=None, date_from=None, date_to=None,
+                    sort="created_at", descending=True):
+    """Get one page of orders and the number of orders matching the filters.
+
+    Dates are inclusive "YYYY-MM-DD" strings; sort is one of created_at,
+    total or status.
+    """
+    return _orders.page(
+        offset=(page - 1) * per_page, limit=per_page, status=status,
+        created_from=date_from, created_to=date_to, sort=sort, descending=descending
+    )
 
 def update_order_status(order_id, status):
     """Update the status of an order."""
-    orders = load_json(ORDERS_FILE)
-    if str(order_id) in orders:
-        orders[str(order_id)]["status"] = status
-        orders[str(order_id)]["updated_at"] = datetime.now().isoformat()
-        save_json(ORDERS_FILE, orders)
-        return True
-    return False
+    if str(order_id) not in _orders.index():
+        return False
+    with _stats.change() as stats:
+        old = _orders.update(order_id, {
+            "status": status,
+            "updated_at": datetime.now().isoformat()
+        })
+        if old is None:
+            return False
+        if old["status"] != status:
+            count_order(stats, str(order_id), old["status"], old["total"], -1)
+            count_order(stats, str(order_id), status, old["total"])
+    return True
+
+# Relational backend: same functions, served from DATABASE_URL instead of the JSON files
+if STORAGE_BACKEND == "sql":
+    from sql_store import (
+        get_all_products, get_product, add_product, upsert_products, update_product, delete_product,
+        get_stock, decrement_stock, restock, get_catalog_version, search_products,
+        get_all_users, get_user, get_user_by_username, get_user_by_email,
+        add_or_update_user, create_user,
+        get_cart, add_to_cart, update_cart_item, clear_cart,
+        create_order, get_order, get_user_orders, get_all_orders, iter_orders, get_orders_page,
+        update_order_status, get_dashboard_stats, get_stamp, commit
+    )
@@ -0,0 +1,409 @@
+import json
+import os
+import logging
+import threading
+import time
+import zlib
+
+from codec import decode
+from store import PRETTY_JSON, JsonStore, file_lock, write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+def empty_cart():
+    return {"items": {}, "total": 0}
+
+
+class Compactor:
+    """Single background thread compacting whichever journals asked for it."""
+
+    def __init__(self):
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wanted = threading.Event()
+        self._thread = None
+
+    def request(self, journal):
+        with self._lock:
+            self._pending.add(journal)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="cart-compactor", daemon=True)
+                self._thread.start()
+        self._wanted.set()
+
+    def _run(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            with self._lock:
+                journals, self._pending = self._pending, set()
+            for journal in journals:
+                try:
+                    journal.compact()
+                except Exception as e:
+                    logger.error(f"Compacting {journal.log_path} failed: {e}")
+
+
+_compactor = Compactor()
+
+
+class CartJournal:
+    """Carts kept as a JSON snapshot plus an append-only log of mutations.
+
+    Every cart change appends one short JSON line to the log, so the cost of a
+    tap no longer depends on how many carts exist. The full state is the
+    snapshot with the log replayed on top of it. Once the log grows past
+    ``compact_after`` entries, a background thread folds it into a fresh
+    snapshot and truncates it.
+
+    Other processes appending to the same log are picked up on the next call
+    by replaying whatever was added since the last read. Appends and
+    compaction take an exclusive lock on ``<log>.lock``; refreshing takes a
+    shared one so it never observes a half-finished compaction.
+
+    Log entries carry increasing sequence numbers and the snapshot records the
+    last one folded into it. Replay skips entries the snapshot already holds,
+    so a crash between writing the snapshot and truncating the log cannot
+    apply the same change twice.
+    """
+
+    def __init__(self, snapshot_path, log_path, compact_after=1000, codec=PRETTY_JSON):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.lock_path = log_path + '.lock'
+        self.compact_after = compact_after
+        self.codec = codec
+
+        self._carts = None
+        self._snapshot_signature = None
+        self._log_inode = None
+        self._log_offset = 0
+        self._log_entries = 0
+        # Sequence number of the last entry in memory, and of the last one in the snapshot
+        self._seq = 0
+        self._snapshot_seq = 0
+
+        self._lock = threading.RLock()
+
+    # Reading
+
+    def unload(self):
+        """Drop the in-memory carts; the next call reloads them from disk."""
+        with self._lock:
+            self._carts = None
+
+    def get(self, user_id):
+        """Return a user's cart, or an empty cart if they have none."""
+        with self._lock:
+            self._refresh()
+            return self._carts.get(str(user_id), empty_cart())
+
+    def all(self):
+        """Return every cart keyed by user id."""
+        with self._lock:
+            self._refresh()
+            return self._carts
+
+    # Mutations
+
+    def add_item(self, user_id, product_id, product_name, price, quantity):
+        """Add quantity of a product to a cart, creating the line if needed."""
+        self._append({
+            "op": "add",
+            "user": str(user_id),
+            "product": str(product_id),
+            "name": product_name,
+            "price": price,
+            "qty": quantity,
+        })
+
+    def set_quantity(self, user_id, product_id, quantity):
+        """Set the quantity of a line already in a cart; zero or less removes it."""
+        self._append({
+            "op": "set",
+            "user": str(user_id),
+            "product": str(product_id),
+            "qty": quantity,
+        })
+
+    def clear(self, user_id):
+        """Empty a user's cart."""
+        self._append({"op": "clear", "user": str(user_id)})
+
+    # Log handling
+
+    def _append(self, entry):
+        with self._lock:
+            with file_lock(self.lock_path):
+                # Catch up first so the entry lands on top of everything logged before it
+                self._refresh(locked=True)
+                entry["seq"] = self._seq + 1
+                with open(self.log_path, 'a') as f:
+                    if f.tell() > self._log_offset:
+                        # A write torn by a crash; cut it off so it can't run into this entry
+                        logger.warning(f"Dropping an incomplete entry at the end of {self.log_path}")
+                        f.truncate(self._log_offset)
+                    f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                    self._log_offset = f.tell()
+                self._apply(entry)
+                self._seq = entry["seq"]
+                self._log_entries += 1
+        if self._log_entries >= self.compact_after:
+            _compactor.request(self)
+
+    def _apply(self, entry):
+        user_id = entry["user"]
+        op = entry["op"]
+
+        if op == "clear":
+            # Replace rather than empty in place; orders may still reference the old items
+            if user_id in self._carts:
+                self._carts[user_id] = empty_cart()
+            return
+
+        cart = self._carts.setdefault(user_id, empty_cart())
+        items = cart["items"]
+        product_id = entry["product"]
+
+        if op == "add":
+            if product_id in items:
+                items[product_id]["quantity"] += entry["qty"]
+            else:
+                items[product_id] = {
+                    "product_name": entry["name"],
+                    "price": entry["price"],
+                    "quantity": entry["qty"]
+                }
+        elif op == "set":
+            if product_id not in items:
+                return
+            if entry["qty"] <= 0:
+                del items[product_id]
+            else:
+                items[product_id]["quantity"] = entry["qty"]
+        else:
+            logger.error(f"Unknown cart journal operation {op!r}")
+            return
+
+        cart["total"] = sum(item["price"] * item["quantity"] for item in items.values())
+
+    def _refresh(self, locked=False):
+        """Bring memory up to date with the snapshot and any log entries added since."""
+        snapshot_signature = JsonStore.signature(self.snapshot_path)
+        try:
+            st = os.stat(self.log_path)
+            log_inode, log_size = st.st_ino, st.st_size
+        except FileNotFoundError:
+            log_inode, log_size = None, 0
+
+        reload_all = (
+            self._carts is None
+            or snapshot_signature != self._snapshot_signature
+            or log_inode != self._log_inode
+            or log_size < self._log_offset
+        )
+        if not reload_all and log_size == self._log_offset:
+            return
+
+        if locked:
+            self._read(reload_all)
+        else:
+            with file_lock(self.lock_path, exclusive=False):
+                self._read(reload_all)
+
+    def _read(self, reload_all):
+        if reload_all:
+            self._carts, self._snapshot_seq = self._read_snapshot()
+            self._snapshot_signature = JsonStore.signature(self.snapshot_path)
+            self._seq = self._snapshot_seq
+            self._log_offset = 0
+            self._log_entries = 0
+
+        try:
+            f = open(self.log_path, 'r')
+        except FileNotFoundError:
+            self._log_inode = None
+            return
+
+        with f:
+            self._log_inode = os.fstat(f.fileno()).st_ino
+            f.seek(self._log_offset)
+            while True:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    # Nothing left, or a torn final write: stop before it
+                    break
+                self._log_offset = f.tell()
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.error(f"Skipping corrupt entry in {self.log_path}")
+                    continue
+                seq = entry.get("seq")
+                if seq is not None:
+                    if seq <= self._snapshot_seq:
+                        # Already in the snapshot: left over from an interrupted compaction
+                        continue
+                    self._seq = max(self._seq, seq)
+                self._apply(entry)
+                self._log_entries += 1
+
+    def _read_snapshot(self):
+        """Return the snapshot's carts and the sequence number of the last log entry it holds."""
+        if not os.path.exists(self.snapshot_path):
+            return {}, 0
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = decode(f.read())
+        except ValueError:
+            logger.error(f"Error decoding data from {self.snapshot_path}")
+            return {}, 0
+        if set(snapshot) == {"seq", "carts"}:
+            return snapshot["carts"], snapshot["seq"]
+        # Written before snapshots recorded a sequence number: just the carts
+        return snapshot, 0
+
+    # Compaction
+
+    def compact(self):
+        """Fold the log into a new snapshot and truncate the log."""
+        with self._lock:
+            with file_lock(self.lock_path):
+                self._refresh(locked=True)
+                if not self._log_entries:
+                    return
+                write_atomic(self.snapshot_path, {"seq": self._seq, "carts": self._carts}, self.codec)
+                # A crash here leaves entries the snapshot already holds; replay skips them by seq
+                with open(self.log_path, 'w'):
+                    pass
+                self._snapshot_seq = self._seq
+                self._snapshot_signature = JsonStore.signature(self.snapshot_path)
+                self._log_inode = os.stat(self.log_path).st_ino
+                self._log_offset = 0
+                self._log_entries = 0
+        logger.debug(f"Compacted cart journal into {self.snapshot_path}")
+
+
+class ShardedCartStore:
+    """Carts split over ``shards`` independent journals by a hash of the user id.
+
+    Each shard is a CartJournal under ``directory``, so a cart change replays
+    and appends to one small shard and never touches the others. Shards are
+    loaded on first use and dropped from memory after ``idle_seconds`` without
+    an access; their files stay on disk and are replayed again when needed.
+
+    The shard count is recorded in ``shards.json`` when the directory is first
+    created, so changing the setting later does not remap existing carts.
+    Carts from the single-file layout (``legacy_snapshot``/``legacy_log``) are
+    split into shards on first use.
+    """
+
+    def __init__(self, directory, shards=64, compact_after=1000, idle_seconds=600,
+                 legacy_snapshot=None, legacy_log=None, codec=PRETTY_JSON):
+        self.directory = directory
+        self.compact_after = compact_after
+        self.codec = codec
+        self.idle_seconds = idle_seconds
+        self.legacy_snapshot = legacy_snapshot
+        self.legacy_log = legacy_log
+        self.requested_shards = shards
+
+        self.shards = None
+        self._journals = {}
+        self._last_used = {}
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def shard_for(self, user_id):
+        """Return the shard number holding a user's cart."""
+        return zlib.crc32(str(user_id).encode()) % self.shards
+
+    def journal(self, user_id):
+        """Return the journal for a user's shard, loading it lazily."""
+        with self._lock:
+            if self.shards is None:
+                self._open()
+            shard = self.shard_for(user_id)
+            journal = self._journals.get(shard)
+            if journal is None:
+                journal = CartJournal(
+                    os.path.join(self.directory, f"{shard}.json"),
+                    os.path.join(self.directory, f"{shard}.log"),
+                    compact_after=self.compact_after,
+                    codec=self.codec
+                )
+                self._journals[shard] = journal
+            now = time.monotonic()
+            self._last_used[shard] = now
+            if now - self._last_sweep > self.idle_seconds / 4:
+                self._evict_idle(now)
+            return journal
+
+    def get(self, user_id):
+        return self.journal(user_id).get(user_id)
+
+    def add_item(self, user_id, product_id, product_name, price, quantity):
+        self.journal(user_id).add_item(user_id, product_id, product_name, price, quantity)
+
+    def set_quantity(self, user_id, product_id, quantity):
+        self.journal(user_id).set_quantity(user_id, product_id, quantity)
+
+    def clear(self, user_id):
+        self.journal(user_id).clear(user_id)
+
+    def all(self):
+        """Return every cart keyed by user id, reading each shard in turn."""
+        with self._lock:
+            if self.shards is None:
+                self._open()
+            shards = self.shards
+        carts = {}
+        for shard in range(shards):
+            journal = CartJournal(
+                os.path.join(self.directory, f"{shard}.json"),
+                os.path.join(self.directory, f"{shard}.log")
+            )
+            carts.update(journal.all())
+        return carts
+
+    def resident_shards(self):
+        """Return how many shards are currently held in memory."""
+        with self._lock:
+            return len(self._journals)
+
+    def _evict_idle(self, now):
+        self._last_sweep = now
+        for shard, last_used in list(self._last_used.items()):
+            if now - last_used > self.idle_seconds:
+                self._journals.pop(shard).unload()
+                del self._last_used[shard]
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        meta_path = os.path.join(self.directory, "shards.json")
+        with file_lock(os.path.join(self.directory, "shards.lock")):
+            if os.path.exists(meta_path):
+                with open(meta_path, 'r') as f:
+                    self.shards = json.load(f)["shards"]
+            else:
+                self.shards = self.requested_shards
+                self._migrate_legacy()
+                write_atomic(meta_path, {"shards": self.shards})
+
+    def _migrate_legacy(self):
+        """Split carts from the single-file journal into shard snapshots."""
+        if not self.legacy_snapshot or not (
+            os.path.exists(self.legacy_snapshot) or os.path.exists(self.legacy_log or '')
+        ):
+            return
+        legacy = CartJournal(self.legacy_snapshot, self.legacy_log)
+        shards = {}
+        for user_id, cart in legacy.all().items():
+            shards.setdefault(self.shard_for(user_id), {})[user_id] = cart
+        for shard, carts in shards.items():
+            write_atomic(os.path.join(self.directory, f"{shard}.json"), carts, self.codec)
+        for path in (self.legacy_snapshot, self.legacy_log):
+            if os.path.exists(path):
+                os.replace(path, path + '.migrated')
+        logger.info(f"Moved {sum(map(len, shards.values()))} carts into {self.directory}")
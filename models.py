@@ -8,6 +8,9 @@ class Admin:
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+# Optional fields every stored product has, filled in for products created without them
+PRODUCT_DEFAULTS = {'description': '', 'image_url': ''}
+
 class Product:
     def __init__(self, id, name, description, price, stock, image_url=None):
         self.id = id
@@ -0,0 +1,135 @@
+"""Streaming order export for bookkeeping, as CSV or NDJSON.
+
+Orders are read one monthly segment at a time (or in batches of rows with
+the SQL backend) and written out in chunks, so memory use stays flat however
+long the order history is. CSV has one row per line item, repeating the
+order's fields; NDJSON has one order per line with its items included.
+
+Usage: ``python order_export.py [--format ndjson] [--status delivered] [--from 2024-01-01] [--to 2024-03-31] [--gzip] [-o orders.csv]``
+"""
+import argparse
+import csv
+import io
+import sys
+import zlib
+
+import data
+from codec import JsonCodec
+
+CSV_COLUMNS = [
+    "order_id", "created_at", "updated_at", "status", "user_id", "customer", "username", "address",
+    "order_total", "product_id", "product_name", "price", "quantity", "line_total"
+]
+
+# Bytes collected before a chunk is handed on
+CHUNK_SIZE = 64 * 1024
+
+# Spreadsheets run cells starting with these as formulas
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+_json = JsonCodec()
+
+
+def csv_cell(value):
+    """Quote a text cell with a leading ' if a spreadsheet would read it as a formula."""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_rows(order):
+    """Return the CSV rows for an order: one per line item, or one without item fields if it has none.
+
+    Text cells are passed through csv_cell, as names and addresses are typed in by customers.
+    """
+    user_data = order.get("user_data") or {}
+    customer = " ".join(name for name in (user_data.get("first_name"), user_data.get("last_name")) if name)
+    head = [
+        order.get("id"), order.get("created_at"), order.get("updated_at", ""), order.get("status"),
+        order.get("user_id"), customer, user_data.get("username") or "", order.get("address") or "",
+        f"{float(order.get('total') or 0):.2f}"
+    ]
+    items = order.get("items") or {}
+    if not items:
+        rows = [head + [""] * 5]
+    else:
+        rows = [
+            head + [
+                product_id, item.get("product_name"), f"{float(item['price']):.2f}", item["quantity"],
+                f"{float(item['price']) * item['quantity']:.2f}"
+            ]
+            for product_id, item in items.items()
+        ]
+    return [[csv_cell(cell) for cell in row] for row in rows]
+
+
+def export_chunks(orders, fmt):
+    """Yield the export of an iterable of orders as byte chunks of about CHUNK_SIZE."""
+    if fmt == "ndjson":
+        chunk = []
+        size = 0
+        for order in orders:
+            line = _json.dumps(order) + b"\n"
+            chunk.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                yield b"".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield b"".join(chunk)
+    elif fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_COLUMNS)
+        for order in orders:
+            writer.writerows(csv_rows(order))
+            if buffer.tell() >= CHUNK_SIZE:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode()
+    else:
+        raise ValueError(f"Unknown export format {fmt!r}")
+
+
+def gzip_chunks(chunks):
+    """Gzip a stream of byte chunks on the fly."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_orders(fmt="csv", status=None, date_from=None, date_to=None, compress=False):
+    """Yield the export of the orders matching the filters, oldest first, as byte chunks."""
+    orders = data.iter_orders(status=status, date_from=date_from, date_to=date_to)
+    chunks = export_chunks(orders, fmt)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export orders with their line items.")
+    parser.add_argument("--format", choices=["csv", "ndjson"], default="csv")
+    parser.add_argument("--status", help="only orders with this status")
+    parser.add_argument("--from", dest="date_from", help="first day, YYYY-MM-DD")
+    parser.add_argument("--to", dest="date_to", help="last day, YYYY-MM-DD")
+    parser.add_argument("--gzip", action="store_true", help="gzip the output")
+    parser.add_argument("-o", "--output", help="file to write; default: standard output")
+    args = parser.parse_args()
+
+    chunks = export_orders(args.format, args.status, args.date_from, args.date_to, args.gzip)
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
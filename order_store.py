@@ -0,0 +1,408 @@
+import bisect
+import hashlib
+import os
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from store import Rollback, file_lock
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_FILE = re.compile(r"^(\d{4}-\d{2})\.json$")
+SEGMENT_INDEX_FILE = re.compile(r"^(\d{4}-\d{2})\.index\.json$")
+
+# Index entry fields the order list can be sorted by
+SORT_KEYS = ("created_at", "total", "status")
+
+# A directory changed this recently may change again within the same mtime tick
+RACY_MTIME_NS = 1_000_000_000
+
+
+def segment_for(created_at):
+    """Return the monthly segment ("YYYY-MM") an order created at created_at belongs to."""
+    return created_at[:7]
+
+
+def index_entry(order, segment):
+    """Return what the index keeps about an order: where it is, and what lists filter and sort on."""
+    return {
+        "segment": segment,
+        "user_id": order["user_id"],
+        "status": order.get("status") or "",
+        "created_at": order.get("created_at") or "",
+        "total": float(order.get("total") or 0)
+    }
+
+
+def _id_key(order_id):
+    # Numeric ids in numeric order
+    return (len(order_id), order_id)
+
+
+def _sort_item(order_id, entry, sort):
+    # Ties are broken by id, numerically when ids are numbers
+    return (entry[sort],) + _id_key(order_id)
+
+
+class OrderStore:
+    """Orders partitioned into monthly segment files, each with its own index.
+
+    ``<directory>/<YYYY-MM>.json`` holds the orders created in that month, and
+    ``<directory>/<YYYY-MM>.index.json`` maps each of them to its segment,
+    user, status, creation time and total. Adding or updating an order
+    rewrites one segment and its index, so a write costs the size of a month
+    however long the history is. ``iter`` streams the history one segment at
+    a time without keeping it in the cache.
+
+    ``index()`` is the union of the segment indexes, held in memory. Every
+    call merges the segment indexes that changed since, whether this process
+    or another one wrote them. Each write renames a new file into the
+    directory, so while the directory's mtime stays the same nothing needs
+    checking, and a call costs a single stat.
+
+    ``page`` lists orders from sorted views of the index, one per sort key and
+    status filter, built the first time they are asked for and kept in order
+    on every change. Only the orders on the requested page are read from
+    their segments.
+
+    Segments read for lookups stay in the cache, but at most
+    ``max_segments`` of them: the least recently used one is dropped from
+    the store when another is loaded. Segment indexes are small and always
+    stay resident.
+
+    All files go through the shared JsonStore, so they get its caching,
+    atomic publishing and cross-process locking. Orders from the single-file
+    layout (``legacy_file``) are split into segments on first use, and the
+    single ``index.json`` of earlier versions is replaced by segment indexes.
+    """
+
+    def __init__(self, directory, store, legacy_file=None, max_segments=12):
+        self.directory = directory
+        self.store = store
+        self.legacy_file = legacy_file
+        self.max_segments = max_segments
+        # Segments held in the store's cache, least recently used first
+        self._resident = OrderedDict()
+        self._ready = False
+        self._lock = threading.RLock()
+        self._reset()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment}.json")
+
+    def segment_index_path(self, segment):
+        return os.path.join(self.directory, f"{segment}.index.json")
+
+    def segments(self):
+        """Return the names of all segments, oldest first."""
+        self._ensure()
+        return self._list(SEGMENT_FILE)
+
+    # Reading
+
+    def index(self):
+        """Return the order id -> {"segment", "user_id", "status", "created_at", "total"} index."""
+        self._ensure()
+        with self._lock:
+            self._sync()
+            return self._index
+
+    def get(self, order_id):
+        entry = self.index().get(str(order_id))
+        if entry is None:
+            return None
+        return self._segment(entry["segment"]).get(str(order_id))
+
+    def stamp(self, order_id=None):
+        """Return the store's (tag, modified) validators for the order list, or for one order.
+
+        The list's validators combine those of every segment index, and one
+        order's are those of its segment. Returns None for an unknown order
+        or when there are no orders yet.
+        """
+        if order_id is None:
+            self._ensure()
+            stamps = [
+                self.store.stamp(self.segment_index_path(segment))
+                for segment in self._list(SEGMENT_INDEX_FILE)
+            ]
+            stamps = [stamp for stamp in stamps if stamp]
+            if not stamps:
+                return None
+            tag = hashlib.blake2b(" ".join(tag for tag, _ in stamps).encode(), digest_size=12).hexdigest()
+            return tag, max(modified for _, modified in stamps)
+        entry = self.index().get(str(order_id))
+        if entry is None:
+            return None
+        stamp = self.store.stamp(self.segment_path(entry["segment"]))
+        self._touch(entry["segment"])
+        return stamp
+
+    def user_order_ids(self, user_id):
+        """Return a user's order ids in id order."""
+        self.index()
+        with self._lock:
+            return self._user_order_ids().get(str(user_id), [])
+
+    def iter(self, newest_first=False, created_from=None, created_to=None):
+        """Yield every order, one segment at a time, in creation order.
+
+        created_from and created_to are inclusive ISO date or time prefixes;
+        segments entirely outside them are not read.
+        """
+        segments = [
+            segment for segment in self.segments()
+            if (not created_from or segment >= created_from[:7])
+            and (not created_to or segment <= created_to[:7])
+        ]
+        if newest_first:
+            segments.reverse()
+        for segment in segments:
+            orders = self.store.read(self.segment_path(segment))
+            values = reversed(list(orders.values())) if newest_first else orders.values()
+            for order in values:
+                created_at = order.get("created_at") or ""
+                if created_from and created_at < created_from:
+                    continue
+                if created_to and created_at[:len(created_to)] > created_to:
+                    continue
+                yield order
+
+    def all(self):
+        """Return every order keyed by id."""
+        return {order["id"]: order for order in self.iter()}
+
+    def page(self, offset=0, limit=50, status=None, created_from=None, created_to=None,
+             sort="created_at", descending=True):
+        """Return (orders, count): one page of the orders matching the filters, and how many match.
+
+        created_from and created_to are inclusive ISO date or time prefixes,
+        e.g. "2024-05-01".
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Cannot sort orders by {sort!r}")
+        index = self.index()
+        with self._lock:
+            items = self._view(sort, status)
+
+            if sort == "created_at":
+                # The view is in creation order, so the date range is a slice of it
+                lo = bisect.bisect_left(items, (created_from,)) if created_from else 0
+                hi = bisect.bisect_left(items, (created_to + "\uffff",)) if created_to else len(items)
+                matching = range(lo, hi)
+            elif created_from or created_to:
+                matching = [
+                    i for i, item in enumerate(items)
+                    if (not created_from or index[item[2]]["created_at"] >= created_from)
+                    and (not created_to or index[item[2]]["created_at"][:len(created_to)] <= created_to)
+                ]
+            else:
+                matching = range(len(items))
+
+            count = len(matching)
+            if descending:
+                positions = matching[::-1][offset:offset + limit]
+            else:
+                positions = matching[offset:offset + limit]
+            order_ids = [items[i][2] for i in positions]
+        # Read each segment once, in case the page spans more of them than stay cached
+        by_segment = {}
+        for order_id in order_ids:
+            by_segment.setdefault(index[order_id]["segment"], []).append(order_id)
+        found = {}
+        for segment, ids in by_segment.items():
+            orders = self._segment(segment)
+            found.update((order_id, orders[order_id]) for order_id in ids if order_id in orders)
+        return [found[order_id] for order_id in order_ids if order_id in found], count
+
+    # Mutations
+
+    def add(self, order):
+        """Store a new order in the segment for its creation month."""
+        self._ensure()
+        segment = segment_for(order["created_at"])
+        with self._lock:
+            with self.store.transaction(self.segment_index_path(segment)) as index:
+                with self.store.transaction(self.segment_path(segment)) as orders:
+                    orders[order["id"]] = order
+                index[order["id"]] = index_entry(order, segment)
+            self._sync(written=segment)
+            self._touch(segment)
+
+    def update(self, order_id, changes):
+        """Apply changes to a stored order; returns its index entry from before, or None if there is no such order."""
+        order_id = str(order_id)
+        entry = self.index().get(order_id)
+        if entry is None:
+            return None
+        segment = entry["segment"]
+        with self._lock:
+            with self.store.transaction(self.segment_index_path(segment)) as index:
+                entry = index.get(order_id)
+                if entry is not None and order_id not in self._segment(segment):
+                    entry = None
+                if entry is None:
+                    raise Rollback
+                with self.store.transaction(self.segment_path(segment)) as orders:
+                    orders[order_id].update(changes)
+                    order = orders[order_id]
+                new_entry = index_entry(order, segment)
+                if new_entry == entry:
+                    raise Rollback
+                index[order_id] = new_entry
+            self._sync(written=segment)
+            self._touch(segment)
+        return entry
+
+    # Resident segments
+
+    def _segment(self, segment):
+        """Return a segment's orders through the cache, keeping at most max_segments of them resident."""
+        orders = self.store.load(self.segment_path(segment))
+        self._touch(segment)
+        return orders
+
+    def _touch(self, segment):
+        """Mark a segment as just used and drop the least recently used ones beyond max_segments."""
+        with self._lock:
+            self._resident[segment] = True
+            self._resident.move_to_end(segment)
+            while len(self._resident) > self.max_segments:
+                oldest, _ = self._resident.popitem(last=False)
+                self.store.evict(self.segment_path(oldest))
+
+    # Merged index
+
+    def _reset(self):
+        """Forget the merged index, so that the next read rebuilds it from the segment indexes."""
+        # Order id -> index entry, over every segment
+        self._index = {}
+        # Segment -> store version of its index last merged into self._index
+        self._merged = {}
+        # (sort key, status) -> sorted items, built on demand
+        self._views = {}
+        # User id -> order ids in id order, built on demand
+        self._by_user = None
+        # Directory mtime when the segment indexes were last all checked
+        self._synced_mtime = None
+
+    def _sync(self, written=None):
+        """Merge the segment indexes that changed since they were last merged. Needs self._lock.
+
+        Skipped when the directory is unchanged since the last check, unless
+        a segment was just written here: with write-behind the change may
+        only be in memory, and a new segment not on disk at all yet.
+        """
+        mtime = os.stat(self.directory).st_mtime_ns
+        if written is None and mtime == self._synced_mtime:
+            return
+        # Too recent to rule out another change within the same tick: check again next time
+        self._synced_mtime = mtime if time.time_ns() - mtime > RACY_MTIME_NS else None
+        segments = self._list(SEGMENT_INDEX_FILE)
+        if written is not None and written not in segments:
+            segments.append(written)
+        for segment in segments:
+            path = self.segment_index_path(segment)
+            version = self.store.version(path)
+            if self._merged.get(segment) == version:
+                continue
+            for order_id, entry in self.store.load(path).items():
+                old_entry = self._index.get(order_id)
+                if old_entry != entry:
+                    self._put(order_id, old_entry, entry)
+            self._merged[segment] = version
+
+    def _put(self, order_id, old_entry, entry):
+        """Make entry the order's index entry, moving it within the views built so far. Needs self._lock."""
+        self._index[order_id] = entry
+        self._place(order_id, old_entry, entry)
+        if old_entry is None and self._by_user is not None:
+            order_ids = self._by_user.setdefault(entry["user_id"], [])
+            order_ids.append(order_id)
+            # New orders arrive in id order; anything else needs moving back into place
+            if len(order_ids) > 1 and _id_key(order_ids[-2]) > _id_key(order_id):
+                order_ids.sort(key=_id_key)
+
+    def _user_order_ids(self):
+        if self._by_user is None:
+            by_user = {}
+            for order_id, entry in self._index.items():
+                by_user.setdefault(entry["user_id"], []).append(order_id)
+            for order_ids in by_user.values():
+                order_ids.sort(key=_id_key)
+            self._by_user = by_user
+        return self._by_user
+
+    def _view(self, sort, status):
+        view = self._views.get((sort, status))
+        if view is None:
+            view = self._views[(sort, status)] = sorted(
+                _sort_item(order_id, entry, sort)
+                for order_id, entry in self._index.items()
+                if status is None or entry["status"] == status
+            )
+        return view
+
+    def _place(self, order_id, old_entry, new_entry):
+        """Move an order within every built view from where old_entry put it to where new_entry does."""
+        for (sort, status), view in self._views.items():
+            if old_entry is not None and status in (None, old_entry["status"]):
+                item = _sort_item(order_id, old_entry, sort)
+                i = bisect.bisect_left(view, item)
+                if i < len(view) and view[i] == item:
+                    del view[i]
+            if status in (None, new_entry["status"]):
+                bisect.insort(view, _sort_item(order_id, new_entry, sort))
+
+    # Layout
+
+    def _list(self, pattern):
+        return sorted(
+            match.group(1)
+            for match in map(pattern.match, os.listdir(self.directory))
+            if match
+        )
+
+    def _ensure(self):
+        if self._ready:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(os.path.join(self.directory, "migrate.lock")):
+            if self.legacy_file and os.path.exists(self.legacy_file):
+                self._migrate_legacy()
+            self._index_segments()
+        self._ready = True
+
+    def _index_segments(self):
+        """Write the index of every segment that has none, e.g. those from before segments had their own."""
+        indexed = set(self._list(SEGMENT_INDEX_FILE))
+        for segment in self._list(SEGMENT_FILE):
+            if segment in indexed:
+                continue
+            with self.store.transaction(self.segment_index_path(segment)) as index:
+                for order_id, order in self.store.read(self.segment_path(segment)).items():
+                    index[order_id] = index_entry(order, segment)
+            logger.info(f"Indexed {len(index)} orders of segment {segment} in {self.directory}")
+        old_index = os.path.join(self.directory, "index.json")
+        if os.path.exists(old_index):
+            os.replace(old_index, old_index + ".migrated")
+
+    def _migrate_legacy(self):
+        """Split orders from the single orders file into monthly segments."""
+        legacy = self.store.read(self.legacy_file)
+        segments = {}
+        for order_id, order in legacy.items():
+            segment = segment_for(order.get("created_at") or "0000-00")
+            segments.setdefault(segment, {})[order_id] = order
+        for segment, orders in segments.items():
+            with self.store.transaction(self.segment_index_path(segment)) as index:
+                with self.store.transaction(self.segment_path(segment)) as stored:
+                    stored.update(orders)
+                for order_id, order in orders.items():
+                    index[order_id] = index_entry(order, segment)
+            self._touch(segment)
+        os.replace(self.legacy_file, self.legacy_file + '.migrated')
+        logger.info(f"Moved {len(legacy)} orders into {len(segments)} segments in {self.directory}")
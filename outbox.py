@@ -0,0 +1,272 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+
+from telegram.error import NetworkError, RetryAfter
+
+from store import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Rate limiter allowing ``rate`` events per second on average, in bursts of up to ``burst``."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Take a token, borrowing from the future if none is left, and return the seconds to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self):
+        """Return whether the bucket has refilled completely, i.e. holds no state worth keeping."""
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+
+class _Message:
+    __slots__ = ("chat_id", "kwargs", "priority", "bulk", "attempts", "chat_slot", "future")
+
+    def __init__(self, chat_id, kwargs, priority, bulk, future):
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.bulk = bulk
+        self.attempts = 0
+        # When the chat token taken for the current attempt is due, or None before one is taken
+        self.chat_slot = None
+        self.future = future
+
+
+class Outbox:
+    """Rate-limited queue for everything the bot sends on its own initiative.
+
+    Telegram allows a bot about 30 messages per second overall, one per second
+    to the same private chat and 20 per minute to the same group, and answers
+    with RetryAfter when pushed harder. Every message first takes a token from
+    its chat's bucket, stepping out of the queue until the chat may be written
+    to again so that other chats aren't held up, and then from the global
+    bucket, which paces the actual API calls. RetryAfter pauses all sending
+    for as long as Telegram asks and re-queues the message; network errors
+    are retried with backoff. Every attempt takes a new chat token, and so
+    does a message whose token fell due during a pause, so neither retries
+    nor the end of a pause let one chat's messages go out back to back.
+
+    Bulk messages (broadcasts) queue behind regular ones such as order
+    notifications, and at most ``max_pending`` of them are queued at a time,
+    so a broadcast to every user is fed in as fast as it can be sent instead
+    of being loaded into memory at once.
+    """
+
+    def __init__(self, bot, rate=30, chat_rate=1, group_per_minute=20, max_pending=1000,
+                 max_in_flight=32, max_attempts=5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_per_minute / 60
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._global = TokenBucket(rate, burst=rate)
+        self._chats = {}
+        self._ready = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._pending = asyncio.Semaphore(max_pending)
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._paused_until = 0.0
+        self._pacer = None
+        self._deliveries = set()
+
+    def start(self):
+        self._pacer = asyncio.create_task(self._pace())
+
+    async def stop(self):
+        """Stop sending; messages still queued are dropped."""
+        tasks = [self._pacer, *self._deliveries] if self._pacer else list(self._deliveries)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._pacer = None
+
+    def pending(self):
+        """Return how many messages are queued and not yet sent."""
+        return self._ready.qsize()
+
+    async def send(self, chat_id, text, bulk=False, **kwargs):
+        """Queue a message and return a future resolving to the sent Message, or None if it failed."""
+        if bulk:
+            await self._pending.acquire()
+        message = _Message(
+            chat_id, dict(kwargs, text=text), priority=1 if bulk else 0, bulk=bulk,
+            future=asyncio.get_running_loop().create_future()
+        )
+        self._enqueue(message)
+        return message.future
+
+    async def broadcast(self, chat_ids, text, **kwargs):
+        """Send text to every chat in chat_ids at the highest allowed rate and return (sent, failed)."""
+        futures = [await self.send(chat_id, text, bulk=True, **kwargs) for chat_id in chat_ids]
+        results = await asyncio.gather(*futures)
+        sent = sum(1 for result in results if result is not None)
+        return sent, len(results) - sent
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                # Forget chats whose bucket has refilled; a fresh bucket behaves the same
+                self._chats = {key: b for key, b in self._chats.items() if not b.is_full()}
+            # Negative ids are groups and channels, which get a per-minute allowance
+            rate = self.group_rate if str(chat_id).startswith('-') else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate)
+        return bucket
+
+    def _enqueue(self, message):
+        self._ready.put_nowait((message.priority, next(self._order), message))
+
+    async def _pace(self):
+        while True:
+            _, _, message = await self._ready.get()
+            if message.chat_slot is None:
+                wait = self._chat_bucket(message.chat_id).reserve()
+                message.chat_slot = time.monotonic() + wait
+                if wait > 0:
+                    # Come back when the chat may be written to again, letting other chats go first
+                    asyncio.get_running_loop().call_later(wait, self._enqueue, message)
+                    continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            if message.chat_slot < self._paused_until:
+                # Its chat token was due while sending was paused, as were those of the
+                # chat's other waiting messages; take a new one to keep them spaced out
+                message.chat_slot = None
+                self._enqueue(message)
+                continue
+            wait = self._global.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._in_flight.acquire()
+            task = asyncio.create_task(self._deliver(message))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, message):
+        try:
+            result = await self.bot.send_message(chat_id=message.chat_id, **message.kwargs)
+        except RetryAfter as e:
+            logger.warning(f"Flood limit hit, pausing outgoing messages for {e.retry_after}s")
+            self._paused_until = max(self._paused_until, time.monotonic() + float(e.retry_after))
+            self._retry(message, e, delay=0)
+        except NetworkError as e:
+            self._retry(message, e, delay=2 ** message.attempts)
+        except Exception as e:
+            self._finish(message, None, e)
+        else:
+            self._finish(message, result)
+        finally:
+            self._in_flight.release()
+
+    def _retry(self, message, error, delay):
+        message.attempts += 1
+        if message.attempts >= self.max_attempts:
+            self._finish(message, None, error)
+            return
+        self.retried += 1
+        message.chat_slot = None
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self._enqueue, message)
+        else:
+            self._enqueue(message)
+
+    def _finish(self, message, result, error=None):
+        if error is None:
+            self.sent += 1
+        else:
+            self.failed += 1
+            logger.error(f"Failed to send message to {message.chat_id}: {error}")
+        if message.bulk:
+            self._pending.release()
+        if not message.future.done():
+            message.future.set_result(result)
+
+
+# Broadcast jobs
+#
+# The admin app and the bot run in different processes, so an announcement is
+# handed over as a job file in BROADCASTS_DIR: <id>.queued.json is written by
+# the admin app, renamed to <id>.sending.json by the one bot process that
+# claims it, and to <id>.done.json with the delivery counts once it is sent.
+
+def queue_broadcast(directory, text):
+    """Create a broadcast job for the bot to pick up and return its id."""
+    os.makedirs(directory, exist_ok=True)
+    job_id = f"{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+    write_atomic(os.path.join(directory, f"{job_id}.queued.json"), {
+        "id": job_id,
+        "text": text,
+        "created_at": datetime.now().isoformat()
+    })
+    return job_id
+
+def list_broadcasts(directory):
+    """Return every broadcast job, newest first, with its status."""
+    if not os.path.isdir(directory):
+        return []
+    jobs = []
+    for name in os.listdir(directory):
+        job_id, _, rest = name.partition('.')
+        status = rest[:-len('.json')] if rest.endswith('.json') else None
+        if status not in ('queued', 'sending', 'done'):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'r') as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            continue  # renamed away while listing
+        job['status'] = status
+        jobs.append(job)
+    return sorted(jobs, key=lambda job: job['id'], reverse=True)
+
+async def watch_broadcasts(outbox, directory, get_chat_ids, interval=5):
+    """Send queued broadcast jobs through outbox, checking directory every interval seconds."""
+    while True:
+        for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else ():
+            if not name.endswith('.queued.json'):
+                continue
+            job_id = name[:-len('.queued.json')]
+            sending = os.path.join(directory, f"{job_id}.sending.json")
+            try:
+                os.rename(os.path.join(directory, name), sending)
+            except FileNotFoundError:
+                continue  # claimed by another bot process
+            try:
+                with open(sending, 'r') as f:
+                    job = json.load(f)
+
+                chat_ids = await get_chat_ids()
+                logger.info(f"Broadcasting {job_id} to {len(chat_ids)} chats")
+                start = time.monotonic()
+                job['sent'], job['failed'] = await outbox.broadcast(chat_ids, job['text'])
+                job['finished_at'] = datetime.now().isoformat()
+                logger.info(f"Broadcast {job_id} finished in {time.monotonic() - start:.0f}s: "
+                            f"{job['sent']} sent, {job['failed']} failed")
+
+                write_atomic(os.path.join(directory, f"{job_id}.done.json"), job)
+                os.remove(sending)
+            except Exception as e:
+                # Left as .sending so it is not sent twice; the admin page shows it as stuck
+                logger.error(f"Broadcast {job_id} failed: {e}")
+        await asyncio.sleep(interval)
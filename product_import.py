@@ -0,0 +1,168 @@
+"""Bulk product import from CSV or NDJSON.
+
+Each row is validated with ``models.Product.from_dict`` and valid rows are
+written in batches through ``data.upsert_products``, so a catalog of tens of
+thousands of products costs one write per batch instead of one per product.
+Rows with an ``id`` that already exists update that product; the others are
+added. Bad rows are reported by line number and skipped.
+
+Usage: ``python product_import.py catalog.csv [--format ndjson] [--batch-size 5000]``
+"""
+import argparse
+import csv
+import io
+import logging
+import math
+import re
+import time
+
+import data
+from codec import JsonCodec
+from config import IMPORT_BATCH_SIZE
+from models import Product
+
+logger = logging.getLogger(__name__)
+
+# Columns a row may set; anything else is ignored
+FIELDS = ("id", "name", "description", "price", "stock", "image_url")
+REQUIRED = ("name", "price", "stock")
+
+# Ids end up in bot callback data split on "_" and in admin URLs, and callback data is capped at 64 bytes
+PRODUCT_ID = re.compile(r"^[0-9A-Za-z-]{1,32}$")
+
+# Errors listed in a report; the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+_json = JsonCodec()
+
+
+def format_for(filename="", content_type=""):
+    """Guess "csv" or "ndjson" from a file name or content type; None if neither fits."""
+    filename = (filename or "").lower()
+    content_type = (content_type or "").lower()
+    if filename.endswith(".csv") or "csv" in content_type:
+        return "csv"
+    if filename.endswith((".ndjson", ".jsonl")) or "ndjson" in content_type or "jsonl" in content_type:
+        return "ndjson"
+    return None
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, row) from a binary stream, with row an error message if the line can't be parsed."""
+    if fmt == "csv":
+        reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+        try:
+            for row in reader:
+                yield reader.line_num, row
+        except (csv.Error, UnicodeDecodeError) as e:
+            yield reader.line_num + 1, f"unreadable CSV, import stopped here: {e}"
+    elif fmt == "ndjson":
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = _json.loads(line)
+            except ValueError as e:
+                yield line_number, f"invalid JSON: {e}"
+                continue
+            yield line_number, row if isinstance(row, dict) else "not a JSON object"
+    else:
+        raise ValueError(f"Unknown import format {fmt!r}")
+
+
+def product_from_row(row):
+    """Validate a row and return the product fields it sets; raises ValueError if it is invalid."""
+    # Empty CSV cells count as not given
+    row = {
+        key.strip(): value.strip() if isinstance(value, str) else value
+        for key, value in row.items()
+        if isinstance(key, str) and key.strip() in FIELDS and value not in (None, "")
+    }
+    missing = [field for field in REQUIRED if field not in row]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    if "id" in row and not PRODUCT_ID.match(str(row["id"])):
+        raise ValueError("id may only contain letters, digits and '-', at most 32 of them")
+    try:
+        product = Product.from_dict(row)
+        whole_stock = float(row["stock"]) == product.stock
+    except (TypeError, ValueError, OverflowError) as e:
+        raise ValueError(f"bad price or stock: {e}")
+    if not math.isfinite(product.price):
+        raise ValueError("price must be a finite number")
+    if not whole_stock:
+        raise ValueError("stock must be a whole number")
+    if product.price < 0 or product.stock < 0:
+        raise ValueError("price and stock can't be negative")
+    fields = product.to_dict()
+    fields["id"] = str(row["id"]) if "id" in row else None
+    return {field: fields[field] for field in FIELDS if field in row}
+
+
+def import_products(stream, fmt, batch_size=IMPORT_BATCH_SIZE):
+    """Import products from a binary stream of CSV or NDJSON and return a report.
+
+    The report counts rows read, products created and updated and rows
+    rejected, lists the first MAX_REPORTED_ERRORS errors as
+    {"line", "error"} and gives the elapsed time and rows per second.
+    """
+    report = {"rows": 0, "created": 0, "updated": 0, "rejected": 0, "errors": []}
+    start = time.perf_counter()
+
+    def write(batch):
+        created, updated = data.upsert_products(batch)
+        report["created"] += created
+        report["updated"] += updated
+
+    batch = []
+    for line_number, row in read_rows(stream, fmt):
+        report["rows"] += 1
+        try:
+            if isinstance(row, str):
+                raise ValueError(row)
+            batch.append(product_from_row(row))
+        except ValueError as e:
+            report["rejected"] += 1
+            if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                report["errors"].append({"line": line_number, "error": str(e)})
+            continue
+        if len(batch) >= batch_size:
+            write(batch)
+            batch = []
+    if batch:
+        write(batch)
+
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    report["rows_per_second"] = round(report["rows"] / report["seconds"]) if report["seconds"] else report["rows"]
+    logger.info(
+        f"Imported {report['rows']} rows: {report['created']} created, {report['updated']} updated, "
+        f"{report['rejected']} rejected, {report['rows_per_second']} rows/s"
+    )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import products from a CSV or NDJSON file.")
+    parser.add_argument("file", help="CSV with a header row, or one JSON object per line")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="default: from the file extension")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="products per write")
+    args = parser.parse_args()
+
+    fmt = args.format or format_for(args.file)
+    if fmt is None:
+        parser.error("cannot tell the format from the file name, pass --format")
+    with open(args.file, "rb") as f:
+        report = import_products(f, fmt, batch_size=args.batch_size)
+
+    for error in report["errors"]:
+        print(f"line {error['line']}: {error['error']}")
+    if report["rejected"] > len(report["errors"]):
+        print(f"... and {report['rejected'] - len(report['errors'])} more errors")
+    print(
+        f"{report['rows']} rows in {report['seconds']}s ({report['rows_per_second']} rows/s): "
+        f"{report['created']} created, {report['updated']} updated, {report['rejected']} rejected"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+
+class _Pick:
+    __slots__ = ("product_id", "quantity", "shown", "task")
+
+    def __init__(self, product_id, shown=1):
+        self.product_id = product_id
+        self.quantity = shown
+        self.shown = shown
+        self.task = None
+
+
+class QuantityPicker:
+    """Quantities being picked on product cards, kept per (message, user) key.
+
+    A ➕/➖ tap only changes the number held here. The card's keyboard is
+    edited once the user has stopped tapping for ``delay`` seconds, so ten
+    quick taps cost one Telegram call instead of ten, and the number on the
+    keyboard is never read back to find the current quantity.
+
+    Only the most recently used ``max_entries`` cards are remembered; an
+    evicted card simply starts again from the quantity on its keyboard. When
+    a message is re-rendered as something else, ``forget`` drops its picks
+    so that no pending edit puts a quantity keyboard back on it.
+    """
+
+    def __init__(self, delay=0.7, max_entries=10000):
+        self.delay = delay
+        self.max_entries = max_entries
+        self.edits = 0
+        self.taps = 0
+        self._picks = OrderedDict()
+        # Message -> keys of the picks on it
+        self._by_message = {}
+
+    def get(self, key, product_id, default=1):
+        """Return the quantity picked on a card, or default if nothing was picked there."""
+        pick = self._picks.get(key)
+        if pick is None or pick.product_id != product_id:
+            return default
+        return pick.quantity
+
+    def adjust(self, key, product_id, delta, shown=1):
+        """Change the quantity picked on a card by delta, never below 1, and return it.
+
+        shown is the quantity on the card's keyboard, where a card that isn't
+        remembered starts from.
+        """
+        pick = self._picks.get(key)
+        if pick is None or pick.product_id != product_id:
+            if pick is not None and pick.task:
+                pick.task.cancel()
+            pick = self._picks[key] = _Pick(product_id, max(1, shown))
+            self._by_message.setdefault(key[0], set()).add(key)
+            while len(self._picks) > self.max_entries:
+                self._drop(next(iter(self._picks)))
+        self._picks.move_to_end(key)
+        pick.quantity = max(1, pick.quantity + delta)
+        self.taps += 1
+        return pick.quantity
+
+    def schedule(self, key, edit):
+        """Call edit(quantity) once no tap has come in for delay seconds, if the card shows a different quantity."""
+        pick = self._picks.get(key)
+        if pick is None:
+            return
+        if pick.task:
+            pick.task.cancel()
+        pick.task = asyncio.create_task(self._edit_later(pick, edit))
+
+    def reset(self, key):
+        """Forget a card's quantity, dropping any pending edit, and return the quantity its keyboard shows."""
+        pick = self._drop(key)
+        return pick.shown if pick is not None else 1
+
+    def forget(self, message):
+        """Drop every pick on a message, with its pending edit, e.g. because the message shows something else now."""
+        for key in list(self._by_message.get(message, ())):
+            self._drop(key)
+
+    def _drop(self, key):
+        pick = self._picks.pop(key, None)
+        if pick is None:
+            return None
+        if pick.task:
+            pick.task.cancel()
+        keys = self._by_message.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_message[key[0]]
+        return pick
+
+    async def _edit_later(self, pick, edit):
+        await asyncio.sleep(self.delay)
+        pick.task = None
+        quantity = pick.quantity
+        if quantity == pick.shown:
+            return
+        try:
+            await edit(quantity)
+            self.edits += 1
+        except BadRequest as e:
+            # Typically the message was deleted or already shows this keyboard
+            logger.debug(f"Quantity keyboard not updated: {e}")
+        except Exception as e:
+            logger.error(f"Failed to update quantity keyboard: {e}")
+            return
+        pick.shown = quantity
@@ -0,0 +1,127 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class RenderCache:
+    """Bounded LRU of rendered messages, keyed by tuples that include data versions.
+
+    Keys carry the version of whatever the message was rendered from (the
+    catalog version for a product list page, the product's own version for a
+    product card), so an edit makes the old entry unreachable instead of
+    needing an explicit purge. Unreachable entries age out of the LRU.
+
+    With ``max_bytes`` set, the total ``weigh(value)`` of the entries (their
+    length by default) is bounded too, for caches whose values vary widely
+    in size.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, weigh=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.weigh = weigh
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, value):
+        """Cache value under key, evicting the least recently used entries, and return it."""
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = value
+            self._bytes += self._size(value)
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                self._drop(next(iter(self._entries)))
+        return value
+
+    def get_or_render(self, key, render):
+        """Return the cached value for key, calling render() to build it on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, render())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _size(self, value):
+        return self.weigh(value) if self.max_bytes is not None else 0
+
+    def _drop(self, key):
+        if key in self._entries:
+            self._bytes -= self._size(self._entries.pop(key))
+
+
+class MessageFingerprints:
+    """Remembers a fingerprint of what was last rendered into each message, to skip no-op edits.
+
+    Editing a message to exactly what it already shows costs an API call and
+    only gets "message is not modified" back. The text and keyboard are
+    fingerprinted separately, so a keyboard-only edit can be checked too.
+    Only the most recently edited ``max_entries`` messages are remembered;
+    for any other message the edit is simply sent.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.skipped = 0
+        self.sent = 0
+        self._entries = OrderedDict()  # key -> (text fingerprint, markup fingerprint)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(value):
+        return hashlib.blake2b(repr(value).encode(), digest_size=8).digest()
+
+    def is_shown(self, key, text=None, markup=None):
+        """Return whether the message already shows this text (None: any text) and markup, counting the outcome."""
+        markup_fp = self.fingerprint(markup)
+        with self._lock:
+            shown = self._entries.get(key)
+            unchanged = (
+                shown is not None and shown[1] == markup_fp
+                and (text is None or shown[0] == self.fingerprint(text))
+            )
+            if unchanged:
+                self.skipped += 1
+                self._entries.move_to_end(key)
+            else:
+                self.sent += 1
+            return unchanged
+
+    def record(self, key, text=None, markup=None):
+        """Remember what a message shows after an edit; text None keeps the previous text."""
+        markup_fp = self.fingerprint(markup)
+        with self._lock:
+            if text is None:
+                shown = self._entries.get(key)
+                if shown is None:
+                    return
+                text_fp = shown[0]
+            else:
+                text_fp = self.fingerprint(text)
+            self._entries[key] = (text_fp, markup_fp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def hit_rate(self):
+        """Return the share of edits that were skipped."""
+        total = self.skipped + self.sent
+        return self.skipped / total if total else 0.0
@@ -0,0 +1,204 @@
+import heapq
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class _ProductHolds:
+    __slots__ = ("lock", "held", "holds", "expiry", "scheduled", "dropped")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.held = 0
+        self.holds = {}         # user id -> (quantity, expires_at)
+        self.expiry = []        # heap of (expires_at, user id), at most one per user; may be early for renewed holds
+        self.scheduled = set()  # user ids with an entry in expiry
+        self.dropped = False    # no longer in StockReservations._products
+
+    def expire(self, now):
+        """Drop holds that have run out and return the ids of their users. Needs self.lock."""
+        expired = []
+        while self.expiry and self.expiry[0][0] <= now:
+            _, user_id = heapq.heappop(self.expiry)
+            self.scheduled.discard(user_id)
+            hold = self.holds.get(user_id)
+            if hold is None:
+                continue
+            if hold[1] <= now:
+                del self.holds[user_id]
+                self.held -= hold[0]
+                expired.append(user_id)
+            else:
+                # Renewed since it was scheduled: look again when the renewed hold runs out
+                heapq.heappush(self.expiry, (hold[1], user_id))
+                self.scheduled.add(user_id)
+        return expired
+
+    def put(self, user_id, quantity, expires_at):
+        """Set a user's hold, replacing any previous one. Needs self.lock."""
+        old = self.holds.pop(user_id, None)
+        if old is not None:
+            self.held -= old[0]
+        if quantity > 0:
+            self.holds[user_id] = (quantity, expires_at)
+            self.held += quantity
+            if user_id not in self.scheduled:
+                heapq.heappush(self.expiry, (expires_at, user_id))
+                self.scheduled.add(user_id)
+
+
+class StockReservations:
+    """Time-limited stock holds taken when items go into a cart.
+
+    Stock on disk only goes down when an order is confirmed, so without holds
+    every shopper sees the last unit as available. Here each (user, product)
+    can hold up to what is in stock minus what everybody else holds; a
+    product's holds and running total sit behind that product's own lock, so
+    shoppers of different products never wait for each other. A hold lasts
+    ``hold_seconds`` after it was last changed. Expired holds are dropped
+    lazily, oldest first, the next time the product is touched, and every
+    product is swept now and then so holds on products nobody touches again
+    go too. A product nobody holds any of is forgotten.
+
+    ``get_stock(product_id)`` returns the stock currently on disk, or None for
+    an unknown product. It is read on every reservation so restocks made in
+    the admin panel count straight away. Holds live in this process only: the
+    stock check made when the order is confirmed remains the final word.
+    """
+
+    def __init__(self, get_stock, hold_seconds=900):
+        self.get_stock = get_stock
+        self.hold_seconds = hold_seconds
+        self.rejected = 0
+        self._products = {}
+        self._by_user = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def _holds(self, product_id):
+        holds = self._products.get(product_id)
+        if holds is None:
+            with self._lock:
+                holds = self._products.setdefault(product_id, _ProductHolds())
+        return holds
+
+    @contextmanager
+    def _locked(self, product_id):
+        """Hold a product's lock with its expired holds dropped; forget the product after if nobody holds any."""
+        while True:
+            holds = self._holds(product_id)
+            with holds.lock:
+                if holds.dropped:
+                    # Forgotten between the lookup and the lock
+                    continue
+                for user_id in holds.expire(time.monotonic()):
+                    self._track(user_id, product_id, False)
+                yield holds
+                if not holds.holds:
+                    with self._lock:
+                        if self._products.get(product_id) is holds:
+                            del self._products[product_id]
+                    holds.dropped = True
+                return
+
+    def _sweep(self, now):
+        """Expire the holds of every product, including those nobody has touched since."""
+        self._last_sweep = now
+        with self._lock:
+            product_ids = list(self._products)
+        for product_id in product_ids:
+            with self._locked(product_id):
+                pass
+
+    def _track(self, user_id, product_id, holding):
+        with self._lock:
+            if holding:
+                self._by_user.setdefault(user_id, set()).add(product_id)
+            elif user_id in self._by_user:
+                self._by_user[user_id].discard(product_id)
+                if not self._by_user[user_id]:
+                    del self._by_user[user_id]
+
+    def available(self, product_id):
+        """Return the stock of a product not held by anyone, or None if it doesn't exist."""
+        stock = self.get_stock(product_id)
+        if stock is None:
+            return None
+        with self._locked(product_id) as holds:
+            return max(0, int(stock) - holds.held)
+
+    def held(self, user_id, product_id):
+        """Return how many units of a product a user currently holds."""
+        with self._locked(product_id) as holds:
+            hold = holds.holds.get(user_id)
+            return hold[0] if hold else 0
+
+    def reserve(self, user_id, product_id, quantity):
+        """Hold quantity more units of a product for a user; return False if there aren't enough."""
+        return self._change(user_id, product_id, lambda current: current + quantity)
+
+    def set(self, user_id, product_id, quantity):
+        """Make a user's hold on a product exactly quantity units; return False if there aren't enough."""
+        return self._change(user_id, product_id, lambda current: quantity)
+
+    def release(self, user_id, product_id=None):
+        """Drop a user's hold on one product, or on every product if product_id is None."""
+        if product_id is None:
+            with self._lock:
+                product_ids = list(self._by_user.get(user_id, ()))
+        else:
+            product_ids = [product_id]
+        for pid in product_ids:
+            with self._locked(pid) as holds:
+                holds.put(user_id, 0, 0)
+                self._track(user_id, pid, False)
+
+    def checkout(self, user_id, quantities, decrement):
+        """Turn a user's holds into a stock decrement.
+
+        Holds are first brought in line with quantities (re-taking any that
+        expired), then ``decrement(quantities)`` must write the new stock and
+        return True. The holds are dropped afterwards, as the units have left
+        the stock for good. Returns False, keeping the holds, if either step
+        fails.
+        """
+        for product_id, quantity in quantities.items():
+            if not self.set(user_id, product_id, quantity):
+                return False
+        if not decrement(quantities):
+            return False
+        self.release(user_id)
+        return True
+
+    def stats(self):
+        """Return counters for monitoring."""
+        with self._lock:
+            products = list(self._products.values())
+            holders = len(self._by_user)
+        return {
+            "products": len(products),
+            "holders": holders,
+            "units_held": sum(holds.held for holds in products),
+            "rejected": self.rejected
+        }
+
+    def _change(self, user_id, product_id, new_quantity):
+        stock = self.get_stock(product_id)
+        if stock is None:
+            return False
+        now = time.monotonic()
+        if now - self._last_sweep > self.hold_seconds / 4:
+            self._sweep(now)
+        with self._locked(product_id) as holds:
+            current = holds.holds.get(user_id, (0, 0))[0]
+            quantity = new_quantity(current)
+            # Room left for this user: stock minus everyone else's holds
+            if quantity > current and quantity > int(stock) - (holds.held - current):
+                self.rejected += 1
+                return False
+            holds.put(user_id, quantity, now + self.hold_seconds)
+            self._track(user_id, product_id, quantity > 0)
+        return True
@@ -0,0 +1,144 @@
+import re
+import threading
+from bisect import bisect_left, insort
+from itertools import islice
+
+_WORD = re.compile(r'\w+')
+
+# Above this many words sharing the query's last prefix, filtering the
+# products matched so far beats intersecting with each word's postings
+_MAX_COMPLETIONS = 128
+
+
+def tokenize(text):
+    """Split text into lowercase words."""
+    return _WORD.findall(str(text or '').lower())
+
+
+class SearchIndex:
+    """In-memory full-text index over product names and descriptions.
+
+    ``_postings`` maps each word to the ids of the products containing it, and
+    ``_words`` keeps the same words sorted so that every word starting with a
+    prefix is one bisect away. A query matches products containing all of its
+    words, the last one as a prefix so that results show up while typing.
+
+    ``sync`` brings the index up to date with a products dict by comparing
+    each product's ``version`` to the one it was indexed at, so after an edit
+    only the products that changed are re-tokenized.
+    """
+
+    def __init__(self):
+        self.version = None
+        self._docs = {}
+        self._postings = {}
+        self._words = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def sync(self, products, version=None):
+        """Index new and edited products, drop deleted ones, and remember the catalog version."""
+        with self._lock:
+            for product_id in [p for p in self._docs if p not in products]:
+                self._remove(product_id)
+            new_words = False
+            for product_id, product in products.items():
+                doc = self._docs.get(product_id)
+                if doc is None or doc[0] != product.get('version'):
+                    self._remove(product_id)
+                    new_words |= self._add(product_id, product, keep_sorted=False)
+            if new_words:
+                # One sort instead of an insort per new word when (re)building
+                self._words = sorted(self._postings)
+            self.version = version
+
+    def add(self, product_id, product):
+        """Index a product, replacing what was indexed for it before."""
+        with self._lock:
+            self._remove(product_id)
+            self._add(product_id, product)
+
+    def remove(self, product_id):
+        """Drop a product from the index."""
+        with self._lock:
+            self._remove(product_id)
+
+    def search(self, query, limit=20):
+        """Return up to limit ids of products matching every word of query."""
+        words = tokenize(query)
+        if not words:
+            return []
+        *whole, prefix = words
+
+        with self._lock:
+            # Intersect the exact words, rarest first, so the working set shrinks fast
+            candidates = None
+            for word in sorted(set(whole), key=lambda w: len(self._postings.get(w, ()))):
+                ids = self._postings.get(word)
+                if not ids:
+                    return []
+                candidates = ids if candidates is None else candidates & ids
+                if not candidates:
+                    return []
+
+            results = []
+            completions = self._completions(prefix)
+            if candidates is not None:
+                completions = list(islice(completions, _MAX_COMPLETIONS + 1))
+                if len(completions) > _MAX_COMPLETIONS:
+                    # Short prefix of many words: check the remaining products' own words instead
+                    for product_id in candidates:
+                        if any(word.startswith(prefix) for word in self._docs[product_id][1]):
+                            results.append(product_id)
+                            if len(results) >= limit:
+                                break
+                    return results
+
+            seen = set()
+            for word in completions:
+                ids = self._postings[word]
+                if candidates is not None:
+                    ids = ids & candidates
+                for product_id in ids:
+                    if product_id not in seen:
+                        seen.add(product_id)
+                        results.append(product_id)
+                        if len(results) >= limit:
+                            return results
+            return results
+
+    def _completions(self, prefix):
+        """Yield indexed words starting with prefix, the exact word first. Needs self._lock."""
+        i = bisect_left(self._words, prefix)
+        while i < len(self._words) and self._words[i].startswith(prefix):
+            yield self._words[i]
+            i += 1
+
+    def _add(self, product_id, product, keep_sorted=True):
+        """Index a product and return whether it brought in new words. Needs self._lock."""
+        new_words = False
+        words = frozenset(tokenize(product.get('name')) + tokenize(product.get('description')))
+        self._docs[product_id] = (product.get('version'), words)
+        for word in words:
+            ids = self._postings.get(word)
+            if ids is None:
+                self._postings[word] = {product_id}
+                new_words = True
+                if keep_sorted:
+                    insort(self._words, word)
+            else:
+                ids.add(product_id)
+        return new_words
+
+    def _remove(self, product_id):
+        doc = self._docs.pop(product_id, None)
+        if doc is None:
+            return
+        for word in doc[1]:
+            ids = self._postings[word]
+            ids.discard(product_id)
+            if not ids:
+                del self._postings[word]
+                del self._words[bisect_left(self._words, word)]
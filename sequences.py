@@ -0,0 +1,56 @@
+import json
+import os
+import logging
+import threading
+
+from store import file_lock, write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class Sequence:
+    """Persistent id counter shared by every process using the same file.
+
+    The last id handed out is stored as a single number in ``file_path``. Each
+    allocation takes an exclusive flock, bumps the number and publishes it with
+    an atomic rename. A crash can therefore only leave a gap, never hand out
+    the same id twice, and no data file has to be loaded to allocate an id.
+
+    ``seed`` is called once, when the counter file does not exist yet, and
+    should return the highest id already in use.
+    """
+
+    def __init__(self, file_path, seed=None):
+        self.file_path = file_path
+        self.lock_path = file_path + '.lock'
+        self.seed = seed
+        self._lock = threading.Lock()
+
+    def next(self):
+        """Allocate and return the next id as a string."""
+        with self._lock, file_lock(self.lock_path):
+            value = self._read() + 1
+            write_atomic(self.file_path, value)
+        return str(value)
+
+    def reserve(self, count):
+        """Allocate count consecutive ids with a single write and return them as strings."""
+        if count <= 0:
+            return []
+        with self._lock, file_lock(self.lock_path):
+            first = self._read() + 1
+            write_atomic(self.file_path, first + count - 1)
+        return [str(value) for value in range(first, first + count)]
+
+    def _read(self):
+        if not os.path.exists(self.file_path):
+            value = self.seed() if self.seed else 0
+            logger.info(f"Starting sequence {self.file_path} after {value}")
+            return value
+        with open(self.file_path, 'r') as f:
+            return int(json.load(f))
+
+
+def max_numeric_id(records):
+    """Return the largest numeric key in records, or 0 if there is none."""
+    return max((int(key) for key in records if str(key).isdigit()), default=0)
@@ -0,0 +1,714 @@
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import Column, Float, Index, Integer, JSON, String, create_engine, delete, func, or_, select, text, update
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import DeclarativeBase, Session
+
+from config import (
+    DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    PRODUCTS_FILE, USERS_FILE, ORDERS_FILE, ORDERS_DIR, CARTS_FILE, CARTS_LOG_FILE, CARTS_DIR
+)
+from search import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+# Word index over product names and descriptions, caught up whenever their search version moves
+_search = SearchIndex()
+
+
+# Schema
+#
+# Each table keeps the full record as a JSON document so the functions below
+# return exactly the dicts the JSON backend does. The columns next to it are
+# the fields that get looked up or filtered on, and they are indexed.
+
+class Base(DeclarativeBase):
+    pass
+
+
+class ProductRow(Base):
+    __tablename__ = "products"
+
+    id = Column(String(64), primary_key=True)
+    name = Column(String(255), index=True)
+    price = Column(Float)
+    stock = Column(Integer)
+    data = Column(JSON, nullable=False)
+
+
+class UserRow(Base):
+    __tablename__ = "users"
+    __table_args__ = (
+        # Only accounts that signed up with an email must have unique usernames; bot
+        # users keep whatever Telegram last reported, which may lag behind renames
+        Index("uq_users_username", "username", unique=True,
+              sqlite_where=text("email IS NOT NULL"), postgresql_where=text("email IS NOT NULL")),
+        Index("uq_users_email", "email", unique=True),
+    )
+
+    id = Column(String(64), primary_key=True)
+    username = Column(String(255), index=True)
+    email = Column(String(255), index=True)
+    data = Column(JSON, nullable=False)
+
+
+class CartItemRow(Base):
+    __tablename__ = "cart_items"
+
+    user_id = Column(String(64), primary_key=True)
+    product_id = Column(String(64), primary_key=True)
+    product_name = Column(String(255))
+    price = Column(Float)
+    quantity = Column(Integer, nullable=False)
+
+
+class OrderRow(Base):
+    __tablename__ = "orders"
+
+    id = Column(String(64), primary_key=True)
+    user_id = Column(String(64), index=True)
+    status = Column(String(32), index=True)
+    created_at = Column(String(32), index=True)
+    total = Column(Float)
+    data = Column(JSON, nullable=False)
+
+
+class SequenceRow(Base):
+    __tablename__ = "sequences"
+
+    name = Column(String(64), primary_key=True)
+    value = Column(Integer, nullable=False)
+
+
+class StatRow(Base):
+    """Dashboard counter: "products", "users", "orders" or "status:<status>" with its revenue."""
+    __tablename__ = "stats"
+
+    name = Column(String(64), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0.0)
+
+
+# Engine
+
+_engine = None
+
+def get_engine():
+    """Create the pooled engine and the schema on first use."""
+    global _engine
+    if _engine is None:
+        options = {"pool_pre_ping": True}
+        if not DATABASE_URL.startswith("sqlite"):
+            options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+        _engine = create_engine(DATABASE_URL, **options)
+        Base.metadata.create_all(_engine)
+        # Tables created before the unique indexes existed don't get them from create_all
+        for index in UserRow.__table__.indexes:
+            if index.unique:
+                try:
+                    index.create(_engine, checkfirst=True)
+                except DBAPIError as e:
+                    logger.error(f"Could not create unique index {index.name}, remove duplicate users first: {e}")
+        with Session(_engine) as session, session.begin():
+            if session.get(SequenceRow, "stats_counted") is None:
+                _count_stats(session)
+    return _engine
+
+def _session():
+    return Session(get_engine(), expire_on_commit=False)
+
+def _next_id(session, name):
+    """Allocate the next id for an entity inside the caller's transaction."""
+    seq = session.execute(
+        select(SequenceRow).where(SequenceRow.name == name).with_for_update()
+    ).scalar_one_or_none()
+    if seq is None:
+        seq = SequenceRow(name=name, value=0)
+        session.add(seq)
+    seq.value += 1
+    return str(seq.value)
+
+def _bump_catalog_version(session):
+    _next_id(session, "catalog_version")
+
+def _bump_search_version(session):
+    """Count a change to product names or descriptions; returns the new search version."""
+    return int(_next_id(session, "search_version"))
+
+def _patch_search(version, products=(), removed=()):
+    """Apply this process's own product edits to the search index.
+
+    Only done when the index is at the version just before, i.e. nobody else
+    edited in between; otherwise the next search syncs it.
+    """
+    if _search.version != version - 1:
+        return
+    for product in products:
+        _search.add(product['id'], product)
+    for product_id in removed:
+        _search.remove(product_id)
+    _search.version = version
+
+def _bump_orders_version(session):
+    _next_id(session, "orders_version")
+
+def _bump_stat(session, name, count=1, revenue=0.0):
+    """Add to a dashboard counter inside the caller's transaction."""
+    changed = session.execute(
+        update(StatRow).where(StatRow.name == name)
+        .values(count=StatRow.count + count, revenue=StatRow.revenue + revenue)
+    ).rowcount
+    if changed:
+        return
+    try:
+        with session.begin_nested():
+            session.add(StatRow(name=name, count=count, revenue=revenue))
+    except IntegrityError:
+        # Created by a concurrent writer in the meantime
+        _bump_stat(session, name, count, revenue)
+
+def _bump_order_stat(session, status, total, count=1):
+    _bump_stat(session, f"status:{status}", count, count * float(total or 0))
+
+def _count_stats(session):
+    """Replace the dashboard counters with a count of the tables, inside the caller's transaction."""
+    session.execute(delete(StatRow))
+    session.add(StatRow(name="products", count=session.execute(
+        select(func.count()).select_from(ProductRow)).scalar_one()))
+    session.add(StatRow(name="users", count=session.execute(
+        select(func.count()).select_from(UserRow)).scalar_one()))
+    orders = 0
+    for status, order_count, revenue in session.execute(
+        select(OrderRow.status, func.count(), func.coalesce(func.sum(OrderRow.total), 0)).group_by(OrderRow.status)
+    ):
+        orders += order_count
+        session.add(StatRow(name=f"status:{status}", count=order_count, revenue=float(revenue)))
+    session.add(StatRow(name="orders", count=orders))
+    session.merge(SequenceRow(name="stats_counted", value=1))
+    logger.info(f"Counted the dashboard counters in {DATABASE_URL}")
+
+def _version(session, name):
+    row = session.get(SequenceRow, name)
+    return row.value if row else 0
+
+def _id_order(column):
+    """Order string ids numerically when they are numbers ("2" before "10")."""
+    return (func.length(column), column)
+
+def _cart_from_rows(rows):
+    cart = {"items": {}, "total": 0}
+    for row in rows:
+        cart["items"][row.product_id] = {
+            "product_name": row.product_name,
+            "price": row.price,
+            "quantity": row.quantity
+        }
+        cart["total"] += row.price * row.quantity
+    return cart
+
+
+def commit():
+    """Every function commits its own transaction, so there is never anything to wait for."""
+
+# Product Management
+def get_all_products():
+    """Get all products."""
+    with _session() as session:
+        rows = session.execute(select(ProductRow).order_by(*_id_order(ProductRow.id))).scalars()
+        return {row.id: row.data for row in rows}
+
+def get_product(product_id):
+    """Get a product by ID."""
+    with _session() as session:
+        row = session.get(ProductRow, str(product_id))
+        return row.data if row else None
+
+def add_product(product_data):
+    """Add a new product."""
+    with _session() as session, session.begin():
+        product_id = _next_id(session, "products")
+        product_data['id'] = product_id
+        product_data['version'] = 1
+        product_data['created_at'] = datetime.now().isoformat()
+        session.add(ProductRow(
+            id=product_id,
+            name=product_data.get('name'),
+            price=product_data.get('price'),
+            stock=product_data.get('stock'),
+            data=product_data
+        ))
+        _bump_catalog_version(session)
+        _bump_stat(session, "products")
+        search_version = _bump_search_version(session)
+    _patch_search(search_version, [product_data])
+    return product_id
+
+def upsert_products(products):
+    """Add or update many products in one transaction; returns the (created, updated) counts."""
+    from models import PRODUCT_DEFAULTS
+
+    now = datetime.now().isoformat()
+    created = updated = 0
+    written = []
+    given_ids = [p['id'] for p in products if p.get('id')]
+    with _session() as session, session.begin():
+        rows = {row.id: row for row in session.execute(
+            select(ProductRow).where(ProductRow.id.in_(given_ids)).with_for_update()
+        ).scalars()} if given_ids else {}
+        seq = session.execute(
+            select(SequenceRow).where(SequenceRow.name == "products").with_for_update()
+        ).scalar_one_or_none()
+        if seq is None:
+            seq = SequenceRow(name="products", value=0)
+            session.add(seq)
+        for product_data in products:
+            product_id = product_data.get('id')
+            row = rows.get(product_id) if product_id else None
+            if row is not None:
+                product = dict(row.data, **product_data)
+                product['version'] = row.data.get('version', 0) + 1
+                product['updated_at'] = now
+                updated += 1
+            else:
+                if not product_id:
+                    seq.value += 1
+                    product_id = str(seq.value)
+                product = {**PRODUCT_DEFAULTS, **product_data, 'id': product_id, 'version': 1, 'created_at': now}
+                row = rows[product_id] = ProductRow(id=product_id)
+                session.add(row)
+                created += 1
+            row.name = product.get('name')
+            row.price = product.get('price')
+            row.stock = product.get('stock')
+            row.data = product
+            written.append(product)
+        # Later ids must not collide with ids given in the import
+        seq.value = max([seq.value] + [int(i) for i in given_ids if i.isdigit()])
+        _bump_catalog_version(session)
+        if created:
+            _bump_stat(session, "products", created)
+        search_version = _bump_search_version(session)
+    _patch_search(search_version, written)
+    return created, updated
+
+def update_product(product_id, product_data):
+    """Update an existing product."""
+    with _session() as session, session.begin():
+        row = session.get(ProductRow, str(product_id))
+        if row is None:
+            return False
+        product_data['id'] = row.id
+        product_data['version'] = row.data.get('version', 0) + 1
+        product_data['updated_at'] = datetime.now().isoformat()
+        row.name = product_data.get('name')
+        row.price = product_data.get('price')
+        row.stock = product_data.get('stock')
+        row.data = product_data
+        _bump_catalog_version(session)
+        search_version = _bump_search_version(session)
+    _patch_search(search_version, [product_data])
+    return True
+
+def delete_product(product_id):
+    """Delete a product."""
+    with _session() as session, session.begin():
+        row = session.get(ProductRow, str(product_id))
+        if row is None:
+            return False
+        session.delete(row)
+        _bump_catalog_version(session)
+        _bump_stat(session, "products", -1)
+        search_version = _bump_search_version(session)
+    _patch_search(search_version, removed=[str(product_id)])
+    return True
+
+def get_stock(product_id):
+    """Get a product's stock, or None if the product doesn't exist."""
+    with _session() as session:
+        stock = session.execute(
+            select(ProductRow.stock).where(ProductRow.id == str(product_id))
+        ).first()
+        return int(stock[0]) if stock else None
+
+def decrement_stock(quantities):
+    """Take sold quantities ({product_id: quantity}) out of stock, for all products or none."""
+    with _session() as session, session.begin():
+        rows = session.execute(
+            select(ProductRow)
+            .where(ProductRow.id.in_([str(product_id) for product_id in quantities]))
+            .with_for_update()
+        ).scalars().all()
+        rows = {row.id: row for row in rows}
+        for product_id, quantity in quantities.items():
+            row = rows.get(str(product_id))
+            if row is None or int(row.stock) < quantity:
+                return False
+        for product_id, quantity in quantities.items():
+            row = rows[str(product_id)]
+            row.stock = int(row.stock) - quantity
+            row.data = dict(row.data, stock=row.stock, version=row.data.get('version', 0) + 1)
+        _bump_catalog_version(session)
+    return True
+
+def restock(quantities):
+    """Put quantities ({product_id: quantity}) back into stock, e.g. for an order that failed after decrement_stock."""
+    quantities = {str(product_id): quantity for product_id, quantity in quantities.items()}
+    with _session() as session, session.begin():
+        rows = session.execute(
+            select(ProductRow).where(ProductRow.id.in_(list(quantities))).with_for_update()
+        ).scalars().all()
+        for row in rows:
+            row.stock = int(row.stock) + quantities[row.id]
+            row.data = dict(row.data, stock=row.stock, version=row.data.get('version', 0) + 1)
+        _bump_catalog_version(session)
+
+def get_catalog_version():
+    """Get a number that changes whenever any product is added, edited or deleted."""
+    with _session() as session:
+        return _version(session, "catalog_version")
+
+def search_products(query, limit=20):
+    """Search products by the words in their name and description."""
+    with _session() as session:
+        # Moves with edits to the words only, not with stock changes
+        version = _version(session, "search_version")
+    if _search.version != version:
+        _search.sync(get_all_products(), version)
+    product_ids = _search.search(query, limit)
+    if not product_ids:
+        return []
+    with _session() as session:
+        rows = {row.id: row.data for row in session.execute(
+            select(ProductRow).where(ProductRow.id.in_(product_ids))
+        ).scalars()}
+    return [rows[product_id] for product_id in product_ids if product_id in rows]
+
+# User Management
+def get_all_users():
+    """Get all users."""
+    with _session() as session:
+        rows = session.execute(select(UserRow)).scalars()
+        return {row.id: row.data for row in rows}
+
+def get_user(user_id):
+    """Get a user by ID."""
+    with _session() as session:
+        row = session.get(UserRow, str(user_id))
+        return row.data if row else None
+
+def get_user_by_username(username):
+    """Get a user by username."""
+    with _session() as session:
+        row = session.execute(
+            select(UserRow).where(UserRow.username == username).limit(1)
+        ).scalar_one_or_none()
+        return row.data if row else None
+
+def get_user_by_email(email):
+    """Get a user by email."""
+    with _session() as session:
+        row = session.execute(
+            select(UserRow).where(UserRow.email == email).limit(1)
+        ).scalar_one_or_none()
+        return row.data if row else None
+
+def add_or_update_user(user_id, user_data):
+    """Add or update a user."""
+    with _session() as session, session.begin():
+        if session.get(UserRow, str(user_id)) is None:
+            _bump_stat(session, "users")
+        session.merge(UserRow(
+            id=str(user_id),
+            username=user_data.get('username'),
+            email=user_data.get('email'),
+            data=user_data
+        ))
+    return str(user_id)
+
+def create_user(username, email, password):
+    """Create a new user with password."""
+    from models import User
+    try:
+        with _session() as session, session.begin():
+            taken = session.execute(
+                select(UserRow.id).where(or_(UserRow.username == username, UserRow.email == email)).limit(1)
+            ).first()
+            if taken:
+                return None
+            user_id = _next_id(session, "users")
+            user = User(id=user_id, username=username, email=email)
+            user.set_password(password)
+            session.add(UserRow(id=user_id, username=username, email=email, data=user.to_dict()))
+            _bump_stat(session, "users")
+    except IntegrityError:
+        # A concurrent signup took the username or email between the check and the insert
+        return None
+    return user_id
+
+# Cart Management
+def get_cart(user_id):
+    """Get a user's shopping cart."""
+    with _session() as session:
+        rows = session.execute(
+            select(CartItemRow).where(CartItemRow.user_id == str(user_id))
+        ).scalars()
+        return _cart_from_rows(rows)
+
+def add_to_cart(user_id, product_id, quantity=1):
+    """Add a product to a user's cart."""
+    product = get_product(product_id)
+    if not product:
+        return False
+
+    with _session() as session, session.begin():
+        row = session.get(CartItemRow, (str(user_id), str(product_id)), with_for_update=True)
+        if row is None:
+            session.add(CartItemRow(
+                user_id=str(user_id),
+                product_id=str(product_id),
+                product_name=product["name"],
+                price=product["price"],
+                quantity=quantity
+            ))
+        else:
+            row.quantity += quantity
+    return True
+
+def update_cart_item(user_id, product_id, quantity):
+    """Update the quantity of a product in a user's cart."""
+    with _session() as session, session.begin():
+        row = session.get(CartItemRow, (str(user_id), str(product_id)), with_for_update=True)
+        if row is None:
+            return False
+        if quantity <= 0:
+            session.delete(row)
+        else:
+            row.quantity = quantity
+    return True
+
+def clear_cart(user_id):
+    """Clear a user's cart."""
+    with _session() as session, session.begin():
+        session.execute(delete(CartItemRow).where(CartItemRow.user_id == str(user_id)))
+    return True
+
+# Order Management
+def create_order(user_id, user_data, address):
+    """Create a new order from a user's cart."""
+    with _session() as session, session.begin():
+        rows = session.execute(
+            select(CartItemRow).where(CartItemRow.user_id == str(user_id)).with_for_update()
+        ).scalars().all()
+        cart = _cart_from_rows(rows)
+        if not cart["items"]:
+            return None
+
+        order_id = _next_id(session, "orders")
+        order = {
+            "id": order_id,
+            "user_id": str(user_id),
+            "user_data": user_data,
+            "items": cart["items"],
+            "total": cart["total"],
+            "address": address,
+            "status": "pending",
+            "created_at": datetime.now().isoformat()
+        }
+        session.add(_order_row(order))
+
+        # Clear the cart in the same transaction
+        session.execute(delete(CartItemRow).where(CartItemRow.user_id == str(user_id)))
+        _bump_orders_version(session)
+        _bump_stat(session, "orders")
+        _bump_order_stat(session, "pending", order["total"])
+    return order_id
+
+def get_order(order_id):
+    """Get an order by ID."""
+    with _session() as session:
+        row = session.get(OrderRow, str(order_id))
+        return row.data if row else None
+
+def get_user_orders(user_id):
+    """Get all orders for a user."""
+    with _session() as session:
+        rows = session.execute(
+            select(OrderRow).where(OrderRow.user_id == str(user_id)).order_by(*_id_order(OrderRow.id))
+        ).scalars()
+        return {row.id: row.data for row in rows}
+
+def get_all_orders():
+    """Get all orders."""
+    with _session() as session:
+        rows = session.execute(select(OrderRow).order_by(*_id_order(OrderRow.id))).scalars()
+        return {row.id: row.data for row in rows}
+
+def iter_orders(newest_first=False, status=None, date_from=None, date_to=None):
+    """Yield all orders one at a time, streaming rows from the database in batches."""
+    created_at = OrderRow.created_at.desc() if newest_first else OrderRow.created_at
+    query = _filter_orders(select(OrderRow.data), status, date_from, date_to).order_by(created_at)
+    with _session() as session:
+        rows = session.execute(query.execution_options(yield_per=500)).scalars()
+        yield from rows
+
+def get_orders_page(page=1, per_page=50, status=None, date_from=None, date_to=None,
+                    sort="created_at", descending=True):
+    """Get one page of orders and the number of orders matching the filters."""
+    columns = {"created_at": OrderRow.created_at, "total": OrderRow.total, "status": OrderRow.status}
+    if sort not in columns:
+        raise ValueError(f"Cannot sort orders by {sort!r}")
+    query = _filter_orders(select(OrderRow), status, date_from, date_to)
+    order_by = [columns[sort], *_id_order(OrderRow.id)]
+    if descending:
+        order_by = [column.desc() for column in order_by]
+    with _session() as session:
+        count = session.execute(select(func.count()).select_from(query.subquery())).scalar_one()
+        rows = session.execute(
+            query.order_by(*order_by).offset((page - 1) * per_page).limit(per_page)
+        ).scalars()
+        return [row.data for row in rows], count
+
+def update_order_status(order_id, status):
+    """Update the status of an order."""
+    with _session() as session, session.begin():
+        row = session.get(OrderRow, str(order_id), with_for_update=True)
+        if row is None:
+            return False
+        order = dict(row.data)
+        if row.status != status:
+            _bump_order_stat(session, row.status, row.total, -1)
+            _bump_order_stat(session, status, row.total)
+        order["status"] = status
+        order["updated_at"] = datetime.now().isoformat()
+        row.status = status
+        row.data = order
+        _bump_orders_version(session)
+    return True
+
+def get_stamp(entity, entity_id=None):
+    """Get (tag, modified) validators for "products", "orders" or one "order"."""
+    with _session() as session:
+        if entity == "products":
+            return f"c{_version(session, 'catalog_version')}", None
+        if entity == "orders":
+            return f"o{_version(session, 'orders_version')}", None
+        if entity == "order":
+            row = session.get(OrderRow, str(entity_id))
+            if row is None:
+                return None
+            changed_at = row.data.get("updated_at") or row.created_at
+            return f"{row.id}-{changed_at}", datetime.fromisoformat(changed_at).timestamp()
+    raise ValueError(f"No stamp for {entity!r}")
+
+def get_dashboard_stats():
+    """Get the entity counts, order count and revenue per status, and pending order ids."""
+    # Counters kept by every write in the stats table; pending ids come from the status index
+    with _session() as session:
+        stats = {"products": 0, "users": 0, "orders": 0, "order_status": {}}
+        for row in session.execute(select(StatRow)).scalars():
+            if row.name.startswith("status:"):
+                stats["order_status"][row.name[len("status:"):]] = {
+                    "count": row.count, "revenue": round(row.revenue, 2)
+                }
+            else:
+                stats[row.name] = row.count
+        stats["pending_order_ids"] = session.execute(
+            select(OrderRow.id).where(OrderRow.status == "pending").order_by(*_id_order(OrderRow.id))
+        ).scalars().all()
+        return stats
+
+def _filter_orders(query, status, date_from, date_to):
+    """Narrow an orders query to a status and an inclusive range of ISO dates."""
+    if status:
+        query = query.where(OrderRow.status == status)
+    if date_from:
+        query = query.where(OrderRow.created_at >= date_from)
+    if date_to:
+        query = query.where(func.substr(OrderRow.created_at, 1, len(date_to)) <= date_to)
+    return query
+
+def _order_row(order):
+    return OrderRow(
+        id=order["id"],
+        user_id=order["user_id"],
+        status=order["status"],
+        created_at=order["created_at"],
+        total=order["total"],
+        data=order
+    )
+
+# Migration
+def migrate_from_json():
+    """Copy the JSON data files into the database, replacing rows with the same ids."""
+    from journal import ShardedCartStore
+    from order_store import OrderStore
+    from sequences import max_numeric_id
+    from store import JsonStore
+
+    # Reads the files in whichever codec they were written with
+    json_store = JsonStore()
+    products = json_store.read(PRODUCTS_FILE)
+    users = json_store.read(USERS_FILE)
+    order_store = OrderStore(ORDERS_DIR, json_store, legacy_file=ORDERS_FILE)
+    orders = order_store.index()
+    carts = ShardedCartStore(
+        CARTS_DIR, legacy_snapshot=CARTS_FILE, legacy_log=CARTS_LOG_FILE
+    ).all()
+
+    with _session() as session, session.begin():
+        for product_id, product in products.items():
+            session.merge(ProductRow(
+                id=str(product_id),
+                name=product.get('name'),
+                price=product.get('price'),
+                stock=product.get('stock'),
+                data=product
+            ))
+        for user_id, user in users.items():
+            session.merge(UserRow(
+                id=str(user_id),
+                username=user.get('username'),
+                email=user.get('email'),
+                data=user
+            ))
+        for order in order_store.iter():
+            session.merge(_order_row(order))
+        for user_id, cart in carts.items():
+            for product_id, item in cart["items"].items():
+                session.merge(CartItemRow(
+                    user_id=str(user_id),
+                    product_id=str(product_id),
+                    product_name=item["product_name"],
+                    price=item["price"],
+                    quantity=item["quantity"]
+                ))
+
+        # Continue numbering after the highest migrated id, never below ids the database already handed out
+        for name, records in (("products", products), ("users", users), ("orders", orders)):
+            seq = session.execute(
+                select(SequenceRow).where(SequenceRow.name == name).with_for_update()
+            ).scalar_one_or_none()
+            if seq is None:
+                session.add(SequenceRow(name=name, value=max_numeric_id(records)))
+            else:
+                seq.value = max(seq.value, max_numeric_id(records))
+
+        # Migrated rows bypassed the counters
+        session.flush()
+        _count_stats(session)
+
+    logger.info(
+        f"Migrated {len(products)} products, {len(users)} users, "
+        f"{len(orders)} orders and {len(carts)} carts to {DATABASE_URL}"
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] != ["migrate"]:
+        print("Usage: python sql_store.py migrate")
+        sys.exit(1)
+    migrate_from_json()
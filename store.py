@@ -0,0 +1,401 @@
+import itertools
+import os
+import logging
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from codec import JsonCodec, decode
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows has no flock
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def file_lock(lock_path, exclusive=True):
+    """Hold an advisory flock on lock_path; shared holders only exclude exclusive ones."""
+    with open(lock_path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+PRETTY_JSON = JsonCodec(pretty=True, fast=False)
+
+
+def write_atomic(file_path, data, codec=PRETTY_JSON):
+    """Encode data with codec into a temporary file and rename it over file_path."""
+    write_bytes_atomic(file_path, codec.dumps(data))
+
+
+def write_bytes_atomic(file_path, raw):
+    """Write raw bytes to a temporary file, fsync it and rename it over file_path."""
+    directory = os.path.dirname(file_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class Rollback(Exception):
+    """Raised inside ``JsonStore.transaction`` to leave the file as it was.
+
+    The transaction swallows it without writing anything, so it must be
+    raised before the block changes the data.
+    """
+
+
+# Source of Document versions; every new or changed document takes the next number
+_versions = itertools.count(1)
+
+
+class Document:
+    """A data file held in memory together with the on-disk signature it was read at."""
+
+    def __init__(self, data, signature, indexes=None, raw=None):
+        self.data = data
+        self.signature = signature
+        # Write-behind only: the file's bytes as last read or written, the base for merging
+        self.raw = raw
+        # Lookup tables derived from data, dropped whenever data is re-read
+        self.indexes = indexes if indexes is not None else {}
+        # Changes whenever the contents may have changed, for keying caches of derived output
+        self.version = next(_versions)
+        # When the contents last changed, in seconds since the epoch
+        self.modified = signature[0] / 1e9 if signature else time.time()
+
+
+class JsonStore:
+    """Resident cache of JSON data files.
+
+    Each file is parsed once and then served from memory. Every read stats the
+    file, so changes written by another process (the admin app or the bot) are
+    picked up as soon as the file's mtime, size or inode change.
+
+    Files are published atomically: a new version is written to a temporary
+    file and renamed into place, so a reader sees either the old or the new
+    contents, never a truncated file. Alongside every data file sits a
+    ``<file>.lock`` used for a shared/exclusive flock protocol. Re-reading a
+    file takes the shared lock, so readers never wait for each other. Writes
+    take the exclusive lock, so writers in all processes are serialised.
+    Read-modify-write cycles must go through ``transaction``, which re-reads
+    the file under the exclusive lock before handing it out.
+
+    The returned objects are shared with the cache: callers that mutate them
+    must do so inside ``transaction`` (or hand them back through ``save``).
+    The same holds for indexes obtained from ``index``: a caller that changes
+    the data must patch the affected indexes before the write, and they stay
+    valid until the file is re-read.
+
+    With ``write_behind`` set to a number of seconds, writes are group
+    committed: a transaction or save only updates memory and marks the file
+    dirty, and a background flusher writes each dirty file once per window,
+    however many changes it collected. Until then this process keeps serving
+    (and building on) its own copy, and other processes see the change after
+    the flush. If another process wrote the file in the meantime, the flush
+    merges by top-level key: keys changed here take this process's value and
+    all others keep what is on disk, so the two only clash when both changed
+    the same key (a product, a user), where this process wins. Call
+    ``commit`` to wait for durability.
+    """
+
+    def __init__(self, codec=PRETTY_JSON, write_behind=0):
+        # Used for writing; files in any codec are readable
+        self.codec = codec
+        self.write_behind = write_behind
+        self._docs = {}
+        self._lock = threading.RLock()
+        # Files whose exclusive lock this process currently holds
+        self._held = set()
+
+        # Write-behind: change counter per file changed in memory but not yet on disk
+        self._dirty = {}
+        self._dirty_added = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+
+    @staticmethod
+    def signature(file_path):
+        """Return a cheap fingerprint of a file's on-disk state, or None if it is missing."""
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    @staticmethod
+    def lock_path(file_path):
+        return file_path + '.lock'
+
+    def _is_current(self, file_path, doc):
+        return doc is not None and (
+            file_path in self._dirty or doc.signature == self.signature(file_path)
+        )
+
+    def load(self, file_path, default=dict):
+        """Return the data for a file, re-reading it only if it changed on disk."""
+        doc = self._docs.get(file_path)
+        if self._is_current(file_path, doc):
+            return doc.data
+
+        with self._lock:
+            try:
+                return self._refresh(file_path, default).data
+            except ValueError:
+                logger.error(f"Error decoding data from {file_path}")
+                self._docs.pop(file_path, None)
+                return default()
+
+    def read(self, file_path, default=dict):
+        """Return a file's data without keeping it in the cache, for one-off scans."""
+        doc = self._docs.get(file_path)
+        if self._is_current(file_path, doc):
+            return doc.data
+        if self.signature(file_path) is None:
+            return default()
+        if file_path in self._held:
+            return self._read(file_path).data
+        with file_lock(self.lock_path(file_path), exclusive=False):
+            return self._read(file_path).data
+
+    def save(self, file_path, data):
+        """Publish data as the new contents of a file and keep it as the cached copy."""
+        with self._lock:
+            if self.write_behind:
+                self._mark_dirty(file_path, data)
+            elif file_path in self._held:
+                self._publish(file_path, data)
+            else:
+                with file_lock(self.lock_path(file_path)):
+                    self._publish(file_path, data)
+
+    @contextmanager
+    def transaction(self, file_path, default=dict):
+        """Hold a file's exclusive lock across a read-modify-write of its data.
+
+        The data handed out is the latest version on disk. It is published when
+        the block exits normally and discarded from the cache if it raises.
+        A block that finds nothing to change raises ``Rollback``, which skips
+        the write and keeps the cached copy. In write-behind mode the data is
+        only marked dirty, and a failed block leaves memory as it was if the
+        file already had unflushed changes.
+        """
+        if self.write_behind:
+            with self._lock:
+                try:
+                    data = self._refresh(file_path, default).data
+                    yield data
+                    self._mark_dirty(file_path, data)
+                except Rollback:
+                    pass
+                except BaseException:
+                    if file_path not in self._dirty:
+                        self._docs.pop(file_path, None)
+                    raise
+            return
+
+        with self._lock:
+            with file_lock(self.lock_path(file_path)):
+                self._held.add(file_path)
+                try:
+                    data = self._refresh(file_path, default).data
+                    yield data
+                    self._publish(file_path, data)
+                except Rollback:
+                    pass
+                except BaseException:
+                    self._docs.pop(file_path, None)
+                    raise
+                finally:
+                    self._held.discard(file_path)
+
+    def index(self, file_path, name, build):
+        """Return a named index over a file's data, calling build(data) only when it is re-read."""
+        with self._lock:
+            data = self.load(file_path)
+            doc = self._docs.get(file_path)
+            if doc is None:
+                return build(data)
+            if name not in doc.indexes:
+                doc.indexes[name] = build(data)
+            return doc.indexes[name]
+
+    def version(self, file_path):
+        """Return a number that changes whenever a file's data changes, here or on disk."""
+        with self._lock:
+            self.load(file_path)
+            doc = self._docs.get(file_path)
+            return doc.version if doc is not None else None
+
+    def stamp(self, file_path):
+        """Return (tag, modified) validators for a file's current data, e.g. for HTTP caching.
+
+        The tag changes with every change to the data, and is the same in
+        every process reading the same file. modified is the time of the last
+        change in seconds since the epoch.
+        """
+        with self._lock:
+            self.load(file_path)
+            doc = self._docs.get(file_path)
+            if doc is None:
+                return None
+            mtime_ns, size, ino = doc.signature or (0, 0, 0)
+            tag = f"{mtime_ns:x}-{size:x}-{ino:x}"
+            if file_path in self._dirty:
+                # Changed in memory since the file was written
+                tag += f"-w{doc.version}"
+            return tag, doc.modified
+
+    def invalidate(self, file_path=None):
+        """Drop one cached file, or all of them, forcing the next read to hit the disk."""
+        with self._lock:
+            if file_path is None:
+                self._docs.clear()
+            else:
+                self._docs.pop(file_path, None)
+
+    def evict(self, file_path):
+        """Drop a cached file to free memory, unless it has changes not yet written."""
+        with self._lock:
+            if file_path not in self._dirty:
+                self._docs.pop(file_path, None)
+
+    def _refresh(self, file_path, default):
+        """Return the cached document, re-reading the file if it changed. Needs self._lock."""
+        doc = self._docs.get(file_path)
+        if self._is_current(file_path, doc):
+            return doc
+
+        if self.signature(file_path) is None:
+            self.save(file_path, default())
+            return self._docs[file_path]
+
+        if file_path in self._held:
+            doc = self._read(file_path)
+        else:
+            with file_lock(self.lock_path(file_path), exclusive=False):
+                doc = self._read(file_path)
+        self._docs[file_path] = doc
+        return doc
+
+    def _read(self, file_path):
+        # Stat before reading: a concurrent publish can only make the signature stale, not wrong
+        signature = self.signature(file_path)
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        return Document(decode(raw), signature, raw=raw if self.write_behind else None)
+
+    def _publish(self, file_path, data):
+        try:
+            write_atomic(file_path, data, self.codec)
+        except Exception:
+            # Whatever is in memory may no longer match the disk
+            self._docs.pop(file_path, None)
+            raise
+        doc = self._docs.get(file_path)
+        # Indexes survive a write of the same object, which callers keep in step
+        indexes = doc.indexes if doc is not None and doc.data is data else None
+        self._docs[file_path] = Document(data, self.signature(file_path), indexes)
+
+    # Write-behind
+
+    def commit(self, file_path=None):
+        """Write one dirty file, or all of them, to disk now and return once they are durable."""
+        with self._lock:
+            paths = [file_path] if file_path is not None else list(self._dirty)
+        for path in paths:
+            self._flush(path)
+
+    def _mark_dirty(self, file_path, data):
+        doc = self._docs.get(file_path)
+        if doc is None or doc.data is not data:
+            doc = self._docs[file_path] = Document(
+                data, doc.signature if doc else None, raw=doc.raw if doc else None
+            )
+        else:
+            doc.version = next(_versions)
+        doc.modified = time.time()
+        self._dirty[file_path] = self._dirty.get(file_path, 0) + 1
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name="store-flusher", daemon=True)
+            self._flusher.start()
+        self._dirty_added.notify()
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while not self._dirty:
+                    self._dirty_added.wait()
+            # Let the window fill up, then write everything collected in one go
+            time.sleep(self.write_behind)
+            try:
+                self.commit()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed: {e}")
+
+    def _flush(self, file_path):
+        with self._flush_lock:
+            with self._lock:
+                changes = self._dirty.get(file_path)
+                if changes is None:
+                    return
+                doc = self._docs[file_path]
+                synced = doc.signature
+                raw = self.codec.dumps(doc.data)
+            with file_lock(self.lock_path(file_path)):
+                unchanged = self.signature(file_path) == synced
+                if unchanged:
+                    write_bytes_atomic(file_path, raw)
+                    signature = self.signature(file_path)
+            if not unchanged:
+                # Written by another process since this one last read or wrote it
+                with self._lock, file_lock(self.lock_path(file_path)):
+                    changes = self._dirty[file_path]
+                    raw = self._merge(file_path)
+                    write_bytes_atomic(file_path, raw)
+                    signature = self.signature(file_path)
+            with self._lock:
+                doc = self._docs.get(file_path)
+                if doc is not None:
+                    doc.signature = signature
+                    doc.raw = raw
+                # Changes made while writing stay dirty for the next flush
+                if self._dirty.get(file_path) == changes:
+                    del self._dirty[file_path]
+
+    def _merge(self, file_path):
+        """Apply the top-level keys changed here to the file's current contents and return them encoded.
+
+        Needs self._lock and the file's exclusive lock. The merged data
+        replaces the cached copy, dropping its indexes.
+        """
+        doc = self._docs[file_path]
+        base = decode(doc.raw) if doc.raw is not None else {}
+        theirs = self._read(file_path).data
+        if isinstance(theirs, dict) and isinstance(doc.data, dict) and isinstance(base, dict):
+            merged = theirs
+            for key in base.keys() - doc.data.keys():
+                merged.pop(key, None)
+            for key, value in doc.data.items():
+                if key not in base or base[key] != value:
+                    merged[key] = value
+        else:
+            merged = doc.data
+        logger.warning(f"{file_path} was changed by another process before its write-behind flush, merged by key")
+        self._docs[file_path] = Document(merged, doc.signature)
+        return self.codec.dumps(merged)
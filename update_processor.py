@@ -0,0 +1,68 @@
+import logging
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates from different users concurrently, but each user's in order.
+
+    Up to ``max_concurrent_updates`` users are served at the same time. An
+    update from a user who already has one in progress is queued behind it
+    and run by that user's task once the earlier ones finish, so cart and
+    checkout state never sees two of the same user's updates at once. A
+    queued update does not take a concurrency slot of its own.
+
+    The table of busy users only holds users with work in flight: an entry is
+    dropped as soon as its queue drains, so idle users cost nothing.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._busy = {}
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return ("user", update.effective_user.id)
+            if update.effective_chat:
+                return ("chat", update.effective_chat.id)
+        return None
+
+    def busy_users(self):
+        """Return how many users currently have updates in flight."""
+        return len(self._busy)
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            await coroutine
+            return
+
+        pending = self._busy.get(key)
+        if pending is not None:
+            pending.append(coroutine)
+            return
+
+        self._busy[key] = pending = deque([coroutine])
+        try:
+            while pending:
+                try:
+                    await pending.popleft()
+                except Exception as e:
+                    logger.error(f"Error processing update for {key}: {e}")
+        finally:
+            del self._busy[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        for pending in self._busy.values():
+            while pending:
+                pending.popleft().close()
+        self._busy.clear()
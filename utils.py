@@ -76,15 +76,15 @@ def format_product_message(product):
     message += f"📦 Stock: {product['stock']}"
     return message
 
-def create_product_keyboard(product_id):
+def create_product_keyboard(product_id, quantity=1):
     """Create keyboard for product actions."""
     keyboard = [
         [
-            InlineKeyboardButton("➖", callback_data=f"qty_decrease_{product_id}"),
-            InlineKeyboardButton("1", callback_data="noop"),
-            InlineKeyboardButton("➕", callback_data=f"qty_increase_{product_id}")
+            InlineKeyboardButton("➖", callback_data=f"qty_decrease_{product_id}_{quantity}"),
+            InlineKeyboardButton(str(quantity), callback_data="noop"),
+            InlineKeyboardButton("➕", callback_data=f"qty_increase_{product_id}_{quantity}")
         ],
-        [InlineKeyboardButton("🛒 Add to Cart", callback_data=f"add_to_cart_{product_id}_1")],
+        [InlineKeyboardButton("🛒 Add to Cart", callback_data=f"add_to_cart_{product_id}_{quantity}")],
         [InlineKeyboardButton("« Back to Products", callback_data="browse_products_1")]
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -105,12 +105,22 @@ def format_order_message(order):
     message += f"Order Date: {order['created_at'].split('T')[0]}"
     return message
 
+async def send_message(context: ContextTypes.DEFAULT_TYPE, chat_id, text, **kwargs):
+    """Send a message through the bot's rate-limited outbox, or directly if it has none."""
+    outbox = context.bot_data.get("outbox")
+    if outbox is not None:
+        # Delivery, retries and failures are handled and logged by the outbox
+        await outbox.send(chat_id, text, **kwargs)
+    else:
+        await context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
 async def send_order_notification(context: ContextTypes.DEFAULT_TYPE, user_id: int, order_id: str, order_details: str):
     """Send order notification to the user."""
     try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"🎉 Order #{order_id} has been placed!\n\n{order_details}",
+        await send_message(
+            context,
+            user_id,
+            f"🎉 Order #{order_id} has been placed!\n\n{order_details}",
             parse_mode='Markdown'
         )
     except Exception as e:
@@ -119,9 +129,10 @@ async def send_order_notification(context: ContextTypes.DEFAULT_TYPE, user_id: i
 async def send_status_update(context: ContextTypes.DEFAULT_TYPE, user_id: int, order_id: str, status: str):
     """Send order status update to the user."""
     try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"🔔 Order #{order_id} status updated: *{status.upper()}*",
+        await send_message(
+            context,
+            user_id,
+            f"🔔 Order #{order_id} status updated: *{status.upper()}*",
             parse_mode='Markdown'
         )
     except Exception as e:
@@ -0,0 +1,146 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Telegram never sends updates anywhere near this big
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class WebhookServer:
+    """HTTP listener that receives updates from Telegram and queues them for the bot.
+
+    Telegram POSTs each update as JSON to the webhook URL, echoing the secret
+    token given to ``setWebhook`` in the ``X-Telegram-Bot-Api-Secret-Token``
+    header. Requests to another path or without the right token are refused.
+    Accepted updates are put on ``application.update_queue``, where the
+    application's own fetcher task dispatches them exactly like polled ones,
+    and answered with 200 straight away so Telegram can send the next one.
+
+    The listener runs on its own threads, so a slow client never holds up the
+    event loop the handlers run on.
+    """
+
+    def __init__(self, application, loop, host, port, path, secret_token):
+        self.application = application
+        self.loop = loop
+        self.path = path
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="webhook", daemon=True)
+        self._thread.start()
+        logger.info(f"Webhook listening on port {self.port}, path {self.path}")
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def accept(self, path, secret_token, body):
+        """Queue the update in body if the request is genuine, and return the HTTP status to answer with."""
+        if path != self.path:
+            return 404
+        if not self.secret_token or not hmac.compare_digest(
+            (secret_token or "").encode(), self.secret_token.encode()
+        ):
+            self.rejected += 1
+            logger.warning("Webhook request with a wrong secret token rejected")
+            return 403
+        try:
+            payload = json.loads(body)
+            # de_json gives None for an empty object rather than failing
+            update = Update.de_json(payload, self.application.bot) if isinstance(payload, dict) else None
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error(f"Webhook request with an unreadable update: {e}")
+            return 400
+        if update is None:
+            logger.error("Webhook request without an update")
+            return 400
+        asyncio.run_coroutine_threadsafe(self.application.update_queue.put(update), self.loop)
+        self.received += 1
+        return 200
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length > MAX_BODY_BYTES:
+                    self._reply(413)
+                    return
+                body = self.rfile.read(length)
+                status = server.accept(
+                    urlsplit(self.path).path,
+                    self.headers.get("X-Telegram-Bot-Api-Secret-Token"),
+                    body
+                )
+                self._reply(status)
+
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(f"Webhook {self.address_string()}: {format % args}")
+
+        return Handler
+
+
+async def serve_webhook(application, url, host, port, secret_token, stop):
+    """Run the bot on webhook updates until the stop event is set."""
+    # Same lifecycle and hooks as run_polling
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        server = WebhookServer(
+            application, asyncio.get_running_loop(), host, port, urlsplit(url).path or "/", secret_token
+        )
+        server.start()
+        try:
+            await application.bot.set_webhook(
+                url=url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES
+            )
+            await application.start()
+            await stop.wait()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        finally:
+            server.stop()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def run_webhook(application, url, host, port, secret_token):
+    """Run the bot on webhook updates until SIGINT or SIGTERM, like run_polling does."""
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await serve_webhook(application, url, host, port, secret_token, stop)
+
+    asyncio.run(main())